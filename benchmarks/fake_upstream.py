@@ -0,0 +1,189 @@
+"""
+Local stand-in for the PurpleAir, OpenWeather and beestat APIs so the exporter
+can be benchmarked without API keys, network or consuming API points.
+
+Serves the endpoints the exporter uses with realistic payloads under the
+/purpleair, /openweather and /beestat path prefixes, optionally adding latency
+and failing a share of requests.
+"""
+
+import argparse
+import http.server
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+# Every sensor reports this often, staggered by sensor index
+REPORT_INTERVAL = 120
+
+def get_sensor(index: int, now: int) -> dict:
+	"""
+	Builds the data of a fake PurpleAir sensor, values drift a little with
+	every report.
+
+	```
+	:return: All fields of the sensor
+	:rtype: dict
+	```
+	"""
+	last_seen = now - ( now + index ) % REPORT_INTERVAL
+	rand = random.Random(index * 1000003 + last_seen)
+
+	sensor = {
+		'sensor_index': index,
+		'last_seen': last_seen,
+		'name': f'Sensor {index}',
+		'model': 'PA-II',
+		'hardware': '2.0+BME280+PMSX003-B+PMSX003-A',
+		'firmware_version': '7.02',
+		'location_type': index % 2,
+		'latitude': 37 + rand.random(),
+		'longitude': -122 + rand.random(),
+		'altitude': rand.randint(0, 500),
+		'confidence': rand.randint(90, 100),
+		'rssi': rand.randint(-80, -40),
+		'pa_latency': rand.randint(100, 900),
+		'uptime': rand.randint(0, 100000),
+	}
+	for channel in [ 'a', 'b' ]:
+		sensor[f'humidity_{channel}'] = rand.randint(20, 70)
+		sensor[f'temperature_{channel}'] = rand.randint(50, 100)
+		sensor[f'pressure_{channel}'] = round(rand.uniform(990, 1030), 2)
+		sensor[f'voc_{channel}'] = None if channel == 'a' else round(rand.uniform(0, 500), 2)
+		for pm in [ '1.0', '2.5_alt', '10.0' ]:
+			sensor[f'pm{pm}_{channel}'] = round(rand.uniform(0, 80), 1)
+		for um in [ '0.3', '0.5', '1.0', '2.5', '5.0', '10.0' ]:
+			sensor[f'{um}_um_count_{channel}'] = rand.randint(0, 3000)
+
+	return sensor
+
+class FakeUpstreamHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, format, *args):
+		pass
+
+	def send_json(self, code: int, data) -> None:
+		body = bytes(json.dumps(data), "utf8")
+		self.send_response(code)
+		self.send_header("Content-type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		url = urllib.parse.urlsplit(self.path)
+		query = dict(urllib.parse.parse_qsl(url.query))
+		now = int(time.time())
+
+		self.server.count(url.path)
+		time.sleep(self.server.latency)
+		if random.random() < self.server.error_rate:
+			self.send_json(503, {'error': 'Injected error'})
+			return
+
+		match url.path.rstrip('/').split('/'):
+			case [ '', 'purpleair', 'v1', 'sensors' ]:
+				fields = [ 'sensor_index' ] + [
+					field for field in query.get('fields', '').split(',') if field != 'sensor_index'
+				]
+				modified_since = int(query.get('modified_since', 0))
+				rows = []
+				for index in query.get('show_only', '').split(','):
+					sensor = get_sensor(int(index), now)
+					if sensor['last_seen'] > modified_since:
+						rows.append([ sensor.get(field) for field in fields ])
+				self.send_json(200, {
+					'time_stamp': now,
+					'data_time_stamp': now,
+					'max_age': int(query.get('max_age', 0)),
+					'fields': fields,
+					'data': rows,
+				})
+			case [ '', 'openweather', 'geo', '1.0', 'zip' ]:
+				self.send_json(200, {
+					'zip': query.get('zip', '').split(',')[0],
+					'name': 'Benchmark',
+					'lat': 37.77,
+					'lon': -122.42,
+					'country': 'US',
+				})
+			case [ '', 'openweather', 'data', '2.5', 'weather' ]:
+				self.send_json(200, {
+					'main': {
+						'temp': 290.5,
+						'feels_like': 289.9,
+						'temp_min': 288.7,
+						'temp_max': 292.1,
+						'pressure': 1015,
+						'humidity': 62,
+					},
+					'visibility': 10000,
+					'wind': { 'speed': 4.1, 'gust': 7.2 },
+					'clouds': { 'all': 40 },
+					'dt': now,
+					'name': 'Benchmark',
+				})
+			case [ '', 'beestat' ] if query.get('method') == 'sync':
+				self.send_json(200, {'success': True, 'data': True})
+			case [ '', 'beestat' ]:
+				self.send_json(200, {'success': True, 'data': {
+					str(index): {
+						'in_use': True,
+						'ecobee_thermostat_id': 1,
+						'ecobee_sensor_id': index,
+						'name': f'Room {index}',
+						'capability': [
+							{'type': 'temperature', 'value': str(680 + index)},
+							{'type': 'humidity', 'value': str(40 + index)},
+						],
+					}
+					for index in range(1, 9)
+				}})
+			case _:
+				self.send_json(404, {'error': 'Not found'})
+
+class FakeUpstreamServer(http.server.ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, server_address: tuple, latency: float = 0, error_rate: float = 0):
+		self.latency = latency
+		self.error_rate = error_rate
+		self.counts = {}
+		self._counts_lock = threading.Lock()
+		super().__init__(server_address, FakeUpstreamHandler)
+
+	def count(self, path: str) -> None:
+		with self._counts_lock:
+			self.counts[path] = self.counts.get(path, 0) + 1
+
+	def get_counts(self) -> dict:
+		with self._counts_lock:
+			return dict(self.counts)
+
+def start(port: int = 0, latency: float = 0, error_rate: float = 0) -> FakeUpstreamServer:
+	"""
+	Starts the fake upstream in a background thread, port 0 picks a free
+	port.
+
+	```
+	:return: The running server
+	:rtype: FakeUpstreamServer
+	```
+	"""
+	server = FakeUpstreamServer(('127.0.0.1', port), latency, error_rate)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--port', type=int, default=9191)
+	parser.add_argument('--latency', type=float, default=0, help='Seconds added to every request')
+	parser.add_argument('--error-rate', type=float, default=0, help='Share of requests failing with a 503')
+	args = parser.parse_args()
+
+	server = FakeUpstreamServer(('127.0.0.1', args.port), args.latency, args.error_rate)
+	print(f'Serving fake upstream APIs on http://127.0.0.1:{args.port}')
+	server.serve_forever()
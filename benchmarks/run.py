@@ -0,0 +1,277 @@
+"""
+Offline benchmark of the exporter against the fake upstream APIs.
+
+Runs the exporter as a subprocess with a generated config pointing at
+fake_upstream, scrapes /metrics and reports scrape latency percentiles,
+upstream requests, CPU time and peak memory of the exporter for each
+scenario:
+
+- cold: no persisted cache, the first scrape after start
+- warm: restarted with the cache persisted by the cold run, then scrapes
+  one after another
+- concurrent: scrapes from several clients at the same time
+
+Needs a POSIX system, resource use is read with os.wait4.
+"""
+
+import argparse
+import http.client
+import os
+import pathlib
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import fake_upstream
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+# Accept headers Prometheus sends for each format
+ACCEPT = {
+	'text': 'text/plain;version=0.0.4;q=0.5,*/*;q=0.1',
+	'openmetrics': 'application/openmetrics-text;version=1.0.0;q=0.5,text/plain;version=0.0.4;q=0.3,*/*;q=0.1',
+	'protobuf': 'application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily;encoding=delimited;q=0.7,text/plain;version=0.0.4;q=0.3,*/*;q=0.1',
+}
+
+CONFIG = """\
+[DEFAULT]
+server_port = {port}
+server_streaming = {streaming}
+cache_file = iot_exporter.cache
+client_retry_backoff = 0.1
+
+[purpleair]
+api_key = benchmark
+sensor_ids = {sensor_ids}
+api_endpoint = {upstream}/purpleair/v1/sensors
+api_cache_time = {cache_time}
+
+[openweather]
+api_key = benchmark
+geo_endpoint = {upstream}/openweather/geo/1.0/zip
+api_endpoint = {upstream}/openweather/data/2.5/weather
+api_cache_time = {cache_time}
+
+[beestat]
+api_key = benchmark
+session_key = benchmark
+api_endpoint = {upstream}/beestat/
+api_cache_time = {cache_time}
+"""
+
+def get_free_port() -> int:
+	with socket.socket() as sock:
+		sock.bind(('127.0.0.1', 0))
+		return sock.getsockname()[1]
+
+def get_percentile(values: list, percentile: float) -> float:
+	"""
+	Gets a percentile of the values with the nearest rank method.
+
+	```
+	:return: The percentile, 0 without values
+	:rtype: float
+	```
+	"""
+	if not values:
+		return 0
+	values = sorted(values)
+	return values[max(0, min(len(values) - 1, round(percentile / 100 * len(values)) - 1))]
+
+class Exporter:
+	"""
+	The exporter running as a subprocess in its own working directory, so it
+	picks up the generated config and keeps its cache file there.
+	"""
+
+	def __init__(self, work_dir: str, port: int, log_level: str, verbose: bool = False):
+		self.port = port
+		output = None if verbose else subprocess.DEVNULL
+		self.process = subprocess.Popen(
+			[ sys.executable, str(ROOT / 'iot_exporter.py'), '--loglevel', log_level ],
+			cwd = work_dir,
+			stdout = output,
+			stderr = output,
+		)
+
+	def wait_ready(self, timeout: float = 30) -> None:
+		until = time.time() + timeout
+		while time.time() < until:
+			if self.process.poll() is not None:
+				raise RuntimeError('The exporter exited with %i' % self.process.returncode)
+			try:
+				socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+				return
+			except OSError:
+				time.sleep(0.01)
+		raise RuntimeError('The exporter did not start listening in time')
+
+	def stop(self) -> dict:
+		"""
+		Stops the exporter and gets the resources it used.
+
+		```
+		:return: CPU seconds and peak resident memory in MiB
+		:rtype: dict
+		```
+		"""
+		self.process.send_signal(signal.SIGINT)
+		try:
+			_, _, usage = os.wait4(self.process.pid, 0)
+		except ChildProcessError:
+			usage = None
+		# Keep Popen from waiting on the process reaped above
+		self.process.returncode = 0
+
+		if usage is None:
+			return { 'cpu': 0, 'rss': 0 }
+		# ru_maxrss is in bytes on macOS and kilobytes elsewhere
+		rss_unit = 1 if sys.platform == 'darwin' else 1024
+		return {
+			'cpu': usage.ru_utime + usage.ru_stime,
+			'rss': usage.ru_maxrss * rss_unit / ( 1024 * 1024 ),
+		}
+
+def scrape(port: int, count: int, accept: str, latencies: list, errors: list) -> None:
+	"""
+	Scrapes /metrics `count` times on a keep-alive connection like
+	Prometheus, appending the latency of each scrape to `latencies`.
+
+	```
+	:return: None
+	:rtype: None
+	```
+	"""
+	connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+	headers = {
+		'Accept': accept,
+		'Accept-Encoding': 'gzip',
+		'X-Prometheus-Scrape-Timeout-Seconds': '10',
+	}
+	for _ in range(count):
+		start = time.perf_counter()
+		try:
+			connection.request('GET', '/metrics', headers=headers)
+			response = connection.getresponse()
+			response.read()
+			if response.status != 200:
+				errors.append(response.status)
+		except (OSError, http.client.HTTPException) as e:
+			errors.append(str(e))
+			connection.close()
+		latencies.append(time.perf_counter() - start)
+	connection.close()
+
+def run_scenario(name: str, args, work_dir: str, upstream: fake_upstream.FakeUpstreamServer) -> dict:
+	"""
+	Starts the exporter, runs the scrapes of a scenario against it and stops
+	it again.
+
+	```
+	:return: Results of the scenario
+	:rtype: dict
+	```
+	"""
+	port = get_free_port()
+	with open(os.path.join(work_dir, 'iot_exporter.ini'), 'w') as config_file:
+		config_file.write(CONFIG.format(
+			port = port,
+			streaming = 'true' if args.streaming else 'false',
+			sensor_ids = ','.join(str(index) for index in range(1, args.sensors + 1)),
+			upstream = 'http://127.0.0.1:%i' % upstream.server_address[1],
+			cache_time = args.cache_time,
+		))
+	if name == 'cold':
+		for file_name in os.listdir(work_dir):
+			if file_name.startswith('iot_exporter.cache'):
+				os.remove(os.path.join(work_dir, file_name))
+
+	upstream_before = sum(upstream.get_counts().values())
+	exporter = Exporter(work_dir, port, args.loglevel, args.verbose)
+	latencies = []
+	errors = []
+	try:
+		exporter.wait_ready()
+		match name:
+			case 'cold':
+				scrape(port, 1, ACCEPT[args.format], latencies, errors)
+			case 'warm':
+				scrape(port, args.scrapes, ACCEPT[args.format], latencies, errors)
+			case 'concurrent':
+				threads = [
+					threading.Thread(target=scrape, args=(
+						port,
+						args.scrapes // args.concurrency,
+						ACCEPT[args.format],
+						latencies,
+						errors,
+					))
+					for _ in range(args.concurrency)
+				]
+				for thread in threads:
+					thread.start()
+				for thread in threads:
+					thread.join()
+	finally:
+		usage = exporter.stop()
+
+	return {
+		'scenario': name,
+		'scrapes': len(latencies),
+		'errors': len(errors),
+		'p50': get_percentile(latencies, 50) * 1000,
+		'p90': get_percentile(latencies, 90) * 1000,
+		'p99': get_percentile(latencies, 99) * 1000,
+		'max': max(latencies, default=0) * 1000,
+		'upstream': sum(upstream.get_counts().values()) - upstream_before,
+		**usage,
+	}
+
+def print_results(results: list) -> None:
+	print('%-11s %8s %7s %9s %9s %9s %9s %9s %8s %9s' % (
+		'scenario', 'scrapes', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'upstream', 'cpu s', 'rss MiB',
+	))
+	for result in results:
+		print('%-11s %8i %7i %9.2f %9.2f %9.2f %9.2f %9i %8.2f %9.1f' % (
+			result['scenario'],
+			result['scrapes'],
+			result['errors'],
+			result['p50'],
+			result['p90'],
+			result['p99'],
+			result['max'],
+			result['upstream'],
+			result['cpu'],
+			result['rss'],
+		))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		description=__doc__,
+		formatter_class=argparse.RawDescriptionHelpFormatter,
+	)
+	parser.add_argument('--sensors', type=int, default=100, help='Number of PurpleAir sensors')
+	parser.add_argument('--latency', type=float, default=0.05, help='Seconds the fake upstream adds to every request')
+	parser.add_argument('--error-rate', type=float, default=0, help='Share of upstream requests failing with a 503')
+	parser.add_argument('--scrapes', type=int, default=200, help='Number of scrapes of the warm and concurrent scenarios')
+	parser.add_argument('--concurrency', type=int, default=8, help='Number of clients of the concurrent scenario')
+	parser.add_argument('--format', choices=ACCEPT.keys(), default='text', help='Exposition format to request')
+	parser.add_argument('--streaming', action='store_true', help='Stream /metrics with server_streaming')
+	parser.add_argument('--cache-time', type=int, default=300, help='api_cache_time of every collector')
+	parser.add_argument('--scenarios', default='cold,warm,concurrent', help='Comma separated scenarios to run')
+	parser.add_argument('--loglevel', default='warning', help='Log level of the exporter')
+	parser.add_argument('--verbose', action='store_true', help='Show the output of the exporter')
+	args = parser.parse_args()
+
+	upstream = fake_upstream.start(latency=args.latency, error_rate=args.error_rate)
+	results = []
+	with tempfile.TemporaryDirectory(prefix='iot_exporter_bench_') as work_dir:
+		for name in args.scenarios.split(','):
+			results.append(run_scenario(name, args, work_dir, upstream))
+	upstream.shutdown()
+
+	print_results(results)
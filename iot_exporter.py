@@ -1,7 +1,5 @@
 import argparse
-import http.server
 import logging
-import socketserver
 
 #
 # Set up args
@@ -23,56 +21,25 @@ logging.info( 'Logging now setup.' )
 # App requirements
 #
 
-from iot_exporter import beestat, openweather, purpleair, util
-
-_conf = util.get_conf()['DEFAULT']
+from iot_exporter import registry, scheduler, server
 
 #
-# Run app
+# Keep cached data fresh in the background
 #
 
-class ExporterHttpRequestHandler(http.server.SimpleHTTPRequestHandler):
-	def do_GET(self):
-		match self.path:
-			case '/metrics':
-				self.send_response(200)
-				self.send_header("Content-type", "text/plain")
-				self.end_headers()
-
-				output = []
-				output += purpleair.collect()
-				output += openweather.collect()
-				output += beestat.collect()
-				output.append("# EOF\n")
-
-				self.wfile.write(bytes(
-					"\n".join(output),
-					"utf8"
-				))
-				return
-			case _:
-				self.send_response(404)
-				self.send_header("Content-type", "text/plain")
-				self.end_headers()
-
-				self.wfile.write(bytes(
-					"404 Not Found\n",
-					"utf8"
-				))
-				return
+registry.schedule()
 
-# Create an object of the above class
-_handler = ExporterHttpRequestHandler
+#
+# Run app
+#
 
-# Create a server
-_server = socketserver.TCPServer(
-	(_conf.get('server_host'), int(_conf.get('server_port'))),
-	_handler
-)
+_server = server.get_server()
 
 # Start the server
 try:
+	scheduler.start()
 	_server.serve_forever()
 except KeyboardInterrupt:
 	print('^C received, shutting down server')
+	scheduler.stop()
 	_server.socket.close()
@@ -0,0 +1,216 @@
+"""
+US EPA AQI calculations based on the Technical Assistance Document for the
+Reporting of Daily Air Quality, with the 2024 PM2.5 breakpoints, and NowCast
+for particulates.
+"""
+
+import bisect
+import math
+import time
+
+# NumPy is optional, with it AQI is calculated for arrays of values at once
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+#
+# Configure Breakpoints
+#
+
+# Pollutant concentrations at the upper end of each AQI category and the AQI
+# index there, values in between are interpolated. Tables not starting at 0
+# are undefined below their first concentration, e.g. 1-hour ozone is only
+# used for high concentrations.
+BREAKPOINTS = {
+
+	# µg/m³, 24-hour
+	'PM2.5': (
+		[ 0, 9.0, 35.4, 55.4, 125.4, 225.4, 325.4 ],
+		[ 0, 50, 100, 150, 200, 300, 500 ],
+	),
+
+	# µg/m³, 24-hour
+	'PM10': (
+		[ 0, 54, 154, 254, 354, 424, 604 ],
+		[ 0, 50, 100, 150, 200, 300, 500 ],
+	),
+
+	# ppm, 8-hour
+	'O3': (
+		[ 0, 0.054, 0.070, 0.085, 0.105, 0.200 ],
+		[ 0, 50, 100, 150, 200, 300 ],
+	),
+
+	# ppm, 1-hour
+	'O3_1H': (
+		[ 0.125, 0.164, 0.204, 0.404, 0.604 ],
+		[ 101, 150, 200, 300, 500 ],
+	),
+
+	# ppm, 8-hour
+	'CO': (
+		[ 0, 4.4, 9.4, 12.4, 15.4, 30.4, 50.4 ],
+		[ 0, 50, 100, 150, 200, 300, 500 ],
+	),
+
+	# ppb, 1-hour
+	'SO2': (
+		[ 0, 35, 75, 185, 304, 604, 1004 ],
+		[ 0, 50, 100, 150, 200, 300, 500 ],
+	),
+
+	# ppb, 1-hour
+	'NO2': (
+		[ 0, 53, 100, 360, 649, 1249, 2049 ],
+		[ 0, 50, 100, 150, 200, 300, 500 ],
+	),
+
+}
+
+#
+# Helper Functions
+#
+
+def get_breakpoints(pollutant: str) -> tuple:
+	"""
+	Gets the breakpoint table of a pollutant.
+
+	```
+	:return: Pollutant concentrations and the AQI index at each breakpoint
+	:rtype: tuple
+	```
+	"""
+	if pollutant not in BREAKPOINTS:
+		raise ValueError(f'{pollutant} is not a supported pollutant.')
+	return BREAKPOINTS[pollutant]
+
+def calc_aqi(pollutant: str, value):
+	"""
+	Calculates the US EPA AQI index for a pollutant concentration, or an array
+	of concentrations with NumPy. Values are clamped to the highest
+	breakpoint, values below a table's first breakpoint have no index.
+
+	```
+	:return: The US EPA AQI index, None or NaN if undefined
+	:rtype: float
+	```
+	"""
+	breakpoint_pollutant, breakpoint_aqi = get_breakpoints(pollutant)
+
+	if numpy is not None and not isinstance(value, (int, float)):
+		index = numpy.interp(value, breakpoint_pollutant, breakpoint_aqi)
+		if breakpoint_pollutant[0] > 0:
+			index = numpy.where(value < breakpoint_pollutant[0], numpy.nan, index)
+		return index
+
+	# First clamp based on min and max
+	if value <= 0 and breakpoint_pollutant[0] == 0:
+		return 0
+	if value < breakpoint_pollutant[0]:
+		return None
+	if value >= breakpoint_pollutant[-1]:
+		return breakpoint_aqi[-1]
+
+	index = bisect.bisect_left(breakpoint_pollutant, value)
+	if breakpoint_pollutant[index] == value:
+		return breakpoint_aqi[index]
+
+	i_lo = breakpoint_aqi[index-1]
+	bp_lo = breakpoint_pollutant[index-1]
+	i_hi = breakpoint_aqi[index]
+	bp_hi = breakpoint_pollutant[index]
+
+	return ( i_hi - i_lo ) / ( bp_hi - bp_lo ) * ( value - bp_lo ) + i_lo
+
+class NowCast:
+	"""
+	NowCast concentration of particulates over the last 12 hours.
+
+	Readings are added to a ring buffer of hourly sums and counts, so adding a
+	reading only updates the bucket of its hour. The NowCast weighs the
+	hourly averages by how much they vary, recent hours the most.
+	"""
+
+	__slots__ = ( 'hour', 'time_stamp', 'sums', 'counts' )
+
+	hours = 12
+
+	def __init__(self, state: list = None):
+		# Newest hour with readings and time of the newest reading
+		self.hour = 0
+		self.time_stamp = 0
+		self.sums = [ 0.0 ] * self.hours
+		self.counts = [ 0 ] * self.hours
+
+		if state:
+			self.hour, self.time_stamp, self.sums, self.counts = state
+
+	def get_state(self) -> list:
+		"""
+		Gets the buffer as plain lists so it can be persisted with `store`.
+
+		```
+		:return: State to construct the NowCast with again
+		:rtype: list
+		```
+		"""
+		return [ self.hour, self.time_stamp, self.sums, self.counts ]
+
+	def add(self, time_stamp: float, value: float) -> None:
+		"""
+		Adds a reading, readings not newer than the last one are ignored so
+		the same data can be added again after every refresh.
+		"""
+		if time_stamp <= self.time_stamp:
+			return
+		self.time_stamp = time_stamp
+
+		hour = int(time_stamp // 3600)
+		if hour > self.hour:
+			# Clear the buckets of hours that passed without readings
+			for passed in range(max(self.hour, hour - self.hours) + 1, hour + 1):
+				self.sums[passed % self.hours] = 0.0
+				self.counts[passed % self.hours] = 0
+			self.hour = hour
+
+		self.sums[hour % self.hours] += value
+		self.counts[hour % self.hours] += 1
+
+	def get(self, now: float = None) -> float:
+		"""
+		Calculates the NowCast concentration as of `now`, which needs readings
+		in at least 2 of the 3 most recent hours.
+
+		```
+		:return: The NowCast concentration or None if there are too few readings
+		:rtype: float
+		```
+		"""
+		current = int(( now or time.time() ) // 3600)
+
+		# Hourly averages, most recent hour first
+		averages = []
+		for age in range(self.hours):
+			hour = current - age
+			bucket = hour % self.hours
+			if hour > self.hour or hour <= self.hour - self.hours or not self.counts[bucket]:
+				averages.append(None)
+			else:
+				averages.append(self.sums[bucket] / self.counts[bucket])
+
+		if sum(average is not None for average in averages[:3]) < 2:
+			return None
+
+		present = [ average for average in averages if average is not None ]
+		if max(present) <= 0:
+			return 0
+
+		factor = max(0.5, min(present) / max(present))
+		weights = [
+			factor ** age if average is not None else 0
+			for age, average in enumerate(averages)
+		]
+		return math.fsum(
+			weight * ( average or 0 ) for weight, average in zip(weights, averages)
+		) / math.fsum(weights)
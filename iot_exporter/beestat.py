@@ -1,21 +1,18 @@
+import functools
 import logging
 import math
-import requests
 import time
+import typing
+import urllib.parse
 
-from iot_exporter import util
+from iot_exporter import client, exposition, history, util
 
 _logger = logging.getLogger(__name__)
 _conf = util.get_conf()['beestat']
-_cache = {}
-_cache_count = {
-	'hit': 0,
-	'miss': 0,
-}
-_session = requests.Session()
-_session.headers.update({
-	'Cookie': f"session_key={_conf.get('session_key')}"
-})
+_accounts = [ ( account, account_conf ) for account, account_conf in util.get_accounts('beestat') if util.is_configured(account_conf) ]
+_cache = util.Cache('beestat')
+_sync_cache = util.Cache('beestat_sync')
+_generation = 0
 
 #
 # Configure Exported Metrics
@@ -45,12 +42,28 @@ METRICS = {
 # Helper Functions
 #
 
+def get_endpoint(request) -> str:
+	"""
+	Gets the API method a request calls, all beestat.io API calls go to the same
+	URL with the method in the query string.
+
+	```
+	:return: The API method, e.g. sensor.sync
+	:rtype: str
+	```
+	"""
+	query = urllib.parse.parse_qs(urllib.parse.urlsplit(request.url).query)
+	return "%s.%s" % (
+		query.get('resource', [ '' ])[0],
+		query.get('method', [ '' ])[0]
+	)
+
 def get_metric(metric: str, data: dict) -> list:
 	outputs = []
 
-	if not data['success'] or 'data' not in data:
+	if not data.get('success') or 'data' not in data:
 		_logger.debug("API data from beestat.io is not valid")
-		return output
+		return outputs
 
 	for sensor_data in data['data'].values():
 		if not sensor_data['in_use']:
@@ -58,11 +71,11 @@ def get_metric(metric: str, data: dict) -> list:
 			continue
 
 		output = {
-			'labels': {
-				'thermostat_id': sensor_data.get('ecobee_thermostat_id'),
-				'sensor_id': sensor_data.get('ecobee_sensor_id'),
-				'name': sensor_data.get('name'),
-			},
+			'labels': (
+				('thermostat_id', sensor_data.get('ecobee_thermostat_id')),
+				('sensor_id', sensor_data.get('ecobee_sensor_id')),
+				('name', sensor_data.get('name')),
+			),
 			'value': None,
 		}
 
@@ -75,95 +88,245 @@ def get_metric(metric: str, data: dict) -> list:
 
 	return outputs
 
-def query_api() -> dict:
-	global _cache
-	global _cache_count
+def get_setting(account_conf, key: str) -> str:
+	# Accounts fall back to the [beestat] section, e.g. for the endpoint
+	return account_conf.get(key, fallback=_conf.get(key))
+
+def get_session(account_conf) -> client.Session:
+	"""
+	Creates the session of an account, each account has its own so its
+	session key cookie and connections aren't shared.
+
+	```
+	:return: The session
+	:rtype: client.Session
+	```
+	"""
+	session = client.Session('beestat', lambda request : get_endpoint(request))
+	session.headers.update({
+		'Cookie': f"session_key={account_conf.get('session_key')}"
+	})
+	return session
+
+_sessions = { account: get_session(account_conf) for account, account_conf in _accounts }
+
+def query_api(account: str, account_conf) -> dict:
+	return _cache.get(
+		('sensors', account),
+		functools.partial(fetch_sensors, account, account_conf),
+		int(get_setting(account_conf, 'api_cache_time'))
+	)
 
-	if 'timestamp' not in _cache:
-		_cache = {
-			'timestamp': 0,
-			'data': {},
+def fetch_sensors(account: str, account_conf) -> dict:
+	response = _sessions[account].get(
+		get_setting(account_conf, 'api_endpoint'),
+		params = {
+			'api_key': account_conf.get('api_key'),
+			'resource': 'ecobee_sensor',
+			'method': 'read_id',
 		}
+	)
 
-	if time.time() - _cache['timestamp'] < int(_conf.get('api_cache_time')):
-		_cache_count['hit'] += 1
-		return _cache['data']
-	else:
-		_cache['timestamp'] = time.time() # stampede protection
-
-	_cache_count['miss'] += 1
+	if response.status_code != 200:
+		_logger.debug("Could not read sensor data")
+		return None
+
+	data = response.json()
+	data['_timestamp'] = time.time()
+	return data
+
+def query_sync(account: str, account_conf) -> bool:
+	return _sync_cache.get(
+		('sync', account),
+		functools.partial(fetch_sync, account, account_conf),
+		int(get_setting(account_conf, 'sync_interval'))
+	)
 
-	response = _session.get(
-		_conf.get('api_endpoint'),
+def fetch_sync(account: str, account_conf) -> bool:
+	response = _sessions[account].get(
+		get_setting(account_conf, 'api_endpoint'),
 		params = {
-			'api_key': _conf.get('api_key'),
+			'api_key': account_conf.get('api_key'),
 			'resource': 'sensor',
 			'method': 'sync',
 		}
 	)
+
 	if response.status_code != 200:
 		_logger.debug("Could not sync sensor data")
+		return None
+
+	return True
+
+def query_accounts(query) -> None:
+	"""
+	Calls a query function for all accounts concurrently, a failing account
+	doesn't hold up the others.
+
+	```
+	:return: None
+	:rtype: None
+	```
+	"""
+	def try_query(account: str, account_conf) -> Exception:
+		try:
+			query(account, account_conf)
+		except Exception as e:
+			return e
+		return None
+
+	accounts = [ account for account, _ in _accounts ]
+	account_confs = [ account_conf for _, account_conf in _accounts ]
+	for account, error in zip(accounts, client.map('beestat', try_query, accounts, account_confs)):
+		if error is not None:
+			_logger.warning("Could not refresh beestat account %s: %s", account or 'beestat', error)
+
+def update_history() -> None:
+	"""
+	Adds the latest raw readings of all sensors in use to the history.
+
+	```
+	:return: None
+	:rtype: None
+	```
+	"""
+	capability_types = [ metric_def['capability_type'] for metric_def in METRICS.values() ]
+
+	for account, _ in _accounts:
+		data = _cache.peek(('sensors', account)) or {}
+		if not data.get('success') or 'data' not in data:
+			continue
 
-	response = _session.get(
-		_conf.get('api_endpoint'),
-		params = {
-			'api_key': _conf.get('api_key'),
-			'resource': 'ecobee_sensor',
-			'method': 'read_id',
-		}
-	)
-
-	if response.status_code == 200:
-		_cache['data'] = response.json()
-		_cache['data']['_timestamp'] = time.time()
-
-	return _cache['data']
-
-def collect() -> list:
-	global _cache_count
-
-	data = query_api()
+		for sensor_data in data['data'].values():
+			if not sensor_data['in_use']:
+				continue
 
-	output = []
+			for capability in sensor_data.get('capability'):
+				if capability.get('type') in capability_types:
+					history.add(
+						'beestat',
+						sensor_data.get('ecobee_sensor_id'),
+						capability.get('type'),
+						data['_timestamp'],
+						capability.get('value')
+					)
+
+def get_data_age() -> float:
+	"""
+	Gets the seconds since the oldest exported sensor data was fetched.
+
+	```
+	:return: Age of the exported data, None if there is no data yet
+	:rtype: float
+	```
+	"""
+	return _cache.get_age([ ('sensors', account) for account, _ in _accounts ])
+
+def get_generation() -> int:
+	"""
+	Gets a counter that goes up every time new upstream data arrived.
+
+	```
+	:return: The current generation of the exported data
+	:rtype: int
+	```
+	"""
+	return _generation
+
+def refresh() -> float:
+	"""
+	Fetches new data from the beestat.io API, called in the background by the
+	scheduler.
+
+	```
+	:return: Seconds until the next refresh is needed
+	:rtype: float
+	```
+	"""
+	global _generation
+
+	version = _cache.get_version()
+	try:
+		_cache.retain([ ('sensors', account) for account, _ in _accounts ])
+		query_accounts(query_api)
+		update_history()
+		_cache.save()
+	finally:
+		# Only render the exposition again once there is new data, request
+		# counts alone don't need a new render.
+		if _cache.get_version() != version:
+			_generation += 1
+
+	return _cache.next_expiry()
+
+def sync() -> float:
+	"""
+	Asks beestat.io to sync the sensors of all accounts with ecobee, called in
+	the background by the scheduler every `sync_interval` seconds apart from
+	refreshes, so reading sensor data never waits on a sync.
+
+	```
+	:return: Seconds until the next sync is needed
+	:rtype: float
+	```
+	"""
+	_sync_cache.retain([ ('sync', account) for account, _ in _accounts ])
+	query_accounts(query_sync)
+	_sync_cache.save()
+
+	return _sync_cache.next_expiry()
+
+def get_jobs() -> list:
+	"""
+	Gets the background jobs besides refresh, beestat.io syncs with ecobee on
+	its own schedule.
+
+	```
+	:return: ( name, function, interval ) of each job
+	:rtype: list
+	```
+	"""
+	return [ ( 'beestat_sync', sync, int(_conf.get('sync_interval')) ) ]
+
+def collect() -> typing.Iterator[exposition.MetricFamily]:
+	"""
+	Collects the metrics from cached data, one metric family at a time.
+
+	```
+	:return: Metric families
+	:rtype: typing.Iterator[exposition.MetricFamily]
+	```
+	"""
+	accounts_data = [ _cache.peek(('sensors', account)) or {} for account, _ in _accounts ]
 
 	# Metric fields
 	for metric_name, metric_def in METRICS.items():
-		for desc in [ 'TYPE', 'UNIT', 'HELP' ]:
-			if desc in metric_def:
-				output.append("# %s %s %s" % (
-					desc,
-					metric_name,
-					metric_def[desc]
-				))
-
-		for metric in get_metric(metric_name, data):
-			if metric['value'] is None:
-				_logger.debug("Did not find a value for: %s", metric_name)
-				continue
-
-			output.append("%s{%s} %f %i" % (
-				metric_name,
-				util.to_label_param(metric['labels']),
-				metric['value'],
-				data['_timestamp'] * 1000
-			))
-
-		output.append('')
+		family = exposition.MetricFamily(metric_name, metric_def)
+		# Thermostats shared with several accounts are only exported once
+		added = set()
+
+		for data in accounts_data:
+			for metric in get_metric(metric_name, data):
+				if metric['value'] is None:
+					_logger.debug("Did not find a value for: %s", metric_name)
+					continue
+				if metric['labels'] in added:
+					continue
+				added.add(metric['labels'])
+
+				family.add(
+					metric['labels'],
+					float(metric['value']),
+					data['_timestamp'] * 1000
+				)
+
+		yield family
 
 	# Meta stats fields
-	meta = 'ecobee_api_requests_total'
-	output.append("# TYPE %s counter" % (meta))
-	output.append("# HELP %s Count of API requests made and skipped due to existing cache" % (meta))
-	output.append('%s{cache="%s"} %f' % (
-		meta,
-		'hit',
-		_cache_count['hit']
-	))
-	output.append('%s{cache="%s"} %f' % (
-		meta,
-		'miss',
-		_cache_count['miss']
-	))
-	output.append('')
-
-	return output
+	meta = exposition.MetricFamily('ecobee_api_requests_total', {
+		'TYPE': 'counter',
+		'HELP': 'Count of API requests made and skipped due to existing cache',
+	})
+	meta.add((('cache', 'hit'),), float(_cache.counts['hit']))
+	meta.add((('cache', 'miss'),), float(_cache.counts['miss']))
+	yield meta
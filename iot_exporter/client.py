@@ -0,0 +1,147 @@
+"""
+Shared HTTP client for upstream APIs with pooled keep-alive connections,
+timeouts, retries and a cap on concurrent requests per host.
+"""
+
+import concurrent.futures
+import logging
+import random
+import threading
+import time
+import urllib.parse
+
+import requests
+import requests.adapters
+
+from iot_exporter import util
+
+_logger = logging.getLogger(__name__)
+_conf = util.get_conf()['DEFAULT']
+_host_limits = {}
+_host_limits_lock = threading.Lock()
+_executors = {}
+_executors_lock = threading.Lock()
+
+# Responses worth retrying, anything else is returned to the caller as is
+RETRY_STATUS_CODES = { 429, 500, 502, 503, 504 }
+
+def get_host_limit(url: str) -> threading.BoundedSemaphore:
+	"""
+	Gets the semaphore limiting concurrent requests to the host of a URL,
+	shared by all sessions.
+
+	```
+	:return: Semaphore for the host
+	:rtype: threading.BoundedSemaphore
+	```
+	"""
+	host = urllib.parse.urlsplit(url).netloc
+	with _host_limits_lock:
+		if host not in _host_limits:
+			_host_limits[host] = threading.BoundedSemaphore(int(_conf.get('client_max_per_host')))
+		return _host_limits[host]
+
+def get_executor(collector: str) -> concurrent.futures.ThreadPoolExecutor:
+	"""
+	Gets the threads of a collector for concurrent requests. Each collector has
+	its own, so a slow upstream host doesn't hold up other collectors.
+
+	```
+	:return: Thread pool of the collector
+	:rtype: concurrent.futures.ThreadPoolExecutor
+	```
+	"""
+	with _executors_lock:
+		if collector not in _executors:
+			_executors[collector] = concurrent.futures.ThreadPoolExecutor(
+				max_workers = int(_conf.get('client_max_per_host')),
+				thread_name_prefix = f'client-{collector}',
+			)
+		return _executors[collector]
+
+def map(collector: str, function, *iterables) -> list:
+	"""
+	Calls `function` for each item concurrently on the client threads of a
+	collector, e.g. to fetch batches of sensors at the same time.
+
+	```
+	:return: Results in the order of the items
+	:rtype: list
+	```
+	"""
+	return list(get_executor(collector).map(function, *iterables))
+
+class Session(requests.Session):
+	"""
+	A requests.Session for one collector. Every request gets the configured
+	timeouts, idempotent requests are retried with jittered backoff, and
+	every attempt records its latency, response size and status code.
+	Endpoints are labeled by URL path unless a `get_endpoint` function taking
+	the prepared request is given.
+	"""
+
+	def __init__(self, collector: str, get_endpoint = None):
+		super().__init__()
+
+		self.collector = collector
+		self.get_endpoint = get_endpoint
+		self.timeout = (
+			float(_conf.get('client_connect_timeout')),
+			float(_conf.get('client_read_timeout')),
+		)
+		self.retries = int(_conf.get('client_retries'))
+		self.retry_backoff = float(_conf.get('client_retry_backoff'))
+
+		adapter = requests.adapters.HTTPAdapter(
+			pool_maxsize = int(_conf.get('client_max_per_host'))
+		)
+		self.mount('http://', adapter)
+		self.mount('https://', adapter)
+
+	def request(self, method, url, **kwargs):
+		kwargs.setdefault('timeout', self.timeout)
+		return super().request(method, url, **kwargs)
+
+	def send(self, request, **kwargs):
+		retries = self.retries if request.method in ('GET', 'HEAD') else 0
+
+		for attempt in range(retries + 1):
+			try:
+				response = self.send_once(request, **kwargs)
+				if attempt == retries or response.status_code not in RETRY_STATUS_CODES:
+					return response
+				response.close()
+				_logger.debug("Retrying %s after status %i", request.url, response.status_code)
+			except (requests.ConnectionError, requests.Timeout) as e:
+				if attempt == retries:
+					raise
+				_logger.debug("Retrying %s after error: %s", request.url, e)
+
+			# Spread retries out so sessions failing together don't retry
+			# together.
+			time.sleep(self.retry_backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+	def send_once(self, request, **kwargs):
+		if self.get_endpoint:
+			endpoint = self.get_endpoint(request)
+		else:
+			endpoint = urllib.parse.urlsplit(request.url).path
+		labels = (
+			('collector', self.collector),
+			('endpoint', endpoint),
+		)
+
+		with get_host_limit(request.url):
+			start = time.perf_counter()
+			try:
+				response = super().send(request, **kwargs)
+				size = len(response.content)
+			except Exception:
+				util.record('iot_exporter_upstream_responses_total', labels + (('code', 'error'),), 1)
+				raise
+			finally:
+				util.record('iot_exporter_upstream_request_duration_seconds', labels, time.perf_counter() - start)
+
+		util.record('iot_exporter_upstream_response_size_bytes', labels, size)
+		util.record('iot_exporter_upstream_responses_total', labels + (('code', str(response.status_code)),), 1)
+		return response
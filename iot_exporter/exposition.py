@@ -0,0 +1,344 @@
+"""
+Sample model the collectors emit, and serializers for the Prometheus text,
+OpenMetrics text and Prometheus protobuf exposition formats.
+"""
+
+import functools
+import struct
+
+from iot_exporter import util
+
+# Bytes of text to gather before handing them to the writer
+CHUNK_SIZE = 64 * 1024
+
+class Sample:
+	"""
+	A single value of a metric family. `suffix` is appended to the family name,
+	e.g. `_bucket` for histograms, and `time_stamp` is in milliseconds.
+	"""
+
+	__slots__ = ( 'suffix', 'labels', 'value', 'time_stamp' )
+
+	def __init__(self, labels: tuple, value, time_stamp: int = None, suffix: str = ''):
+		self.suffix = suffix
+		self.labels = labels
+		self.value = value
+		self.time_stamp = time_stamp
+
+class MetricFamily:
+	"""
+	A metric with its metadata and samples. The metadata is taken from the
+	`TYPE`, `UNIT` and `HELP` keys of a metric definition like the exporters'
+	METRICS.
+	"""
+
+	__slots__ = ( 'name', 'type', 'unit', 'help', 'samples' )
+
+	def __init__(self, name: str, metric_def: dict):
+		self.name = name
+		self.type = metric_def.get('TYPE')
+		self.unit = metric_def.get('UNIT')
+		self.help = metric_def.get('HELP')
+		self.samples = []
+
+	def add(self, labels: tuple, value, time_stamp: int = None, suffix: str = '') -> None:
+		self.samples.append(Sample(labels, value, time_stamp, suffix))
+
+@functools.lru_cache(maxsize=1024)
+def get_text_header(name: str, type: str, unit: str, help: str) -> str:
+	"""
+	Gets the header lines of a metric family, cached as families are created
+	again with every collect.
+
+	```
+	:return: The header lines for the metric
+	:rtype: str
+	```
+	"""
+	metric_def = { 'TYPE': type, 'UNIT': unit, 'HELP': help }
+	return util.get_header(name, {
+		desc: value for desc, value in metric_def.items() if value is not None
+	})
+
+def write_text(families: list, write, chunk_size: int = CHUNK_SIZE) -> None:
+	"""
+	Serializes metric families in the text exposition format, passing the
+	encoded text to `write` in chunks of about `chunk_size` bytes. Integer
+	values are written as such, anything else as a float.
+
+	```
+	:return: None
+	:rtype: None
+	```
+	"""
+	chunk = []
+	size = 0
+
+	for family in families:
+		header = get_text_header(family.name, family.type, family.unit, family.help)
+		chunk.append(header + "\n")
+		size += len(header)
+
+		for sample in family.samples:
+			line = util.get_sample_prefix(family.name + sample.suffix, sample.labels)
+			if isinstance(sample.value, int):
+				line += "%i" % sample.value
+			else:
+				line += "%f" % sample.value
+			if sample.time_stamp is not None:
+				line += " %i" % sample.time_stamp
+			chunk.append(line + "\n")
+			size += len(line)
+
+		chunk.append("\n")
+
+		if size >= chunk_size:
+			write(bytes("".join(chunk), "utf8"))
+			chunk = []
+			size = 0
+
+	if chunk:
+		write(bytes("".join(chunk), "utf8"))
+
+@functools.lru_cache(maxsize=1024)
+def get_openmetrics_header(name: str, type: str, unit: str, help: str) -> str:
+	"""
+	Gets the OpenMetrics descriptor lines of a metric family, counters are
+	described without their `_total` suffix.
+
+	```
+	:return: The descriptor lines for the metric
+	:rtype: str
+	```
+	"""
+	if type == 'counter' and name.endswith('_total'):
+		name = name[:-len('_total')]
+	return get_text_header(name, type, unit, help)
+
+def write_openmetrics(families: list, write, chunk_size: int = CHUNK_SIZE) -> None:
+	"""
+	Serializes metric families in the OpenMetrics text format, passing the
+	encoded text to `write` in chunks of about `chunk_size` bytes. The `# EOF`
+	line is left to the caller.
+
+	```
+	:return: None
+	:rtype: None
+	```
+	"""
+	chunk = []
+	size = 0
+
+	for family in families:
+		header = get_openmetrics_header(family.name, family.type, family.unit, family.help)
+		chunk.append(header + "\n")
+		size += len(header)
+
+		for sample in family.samples:
+			line = util.get_sample_prefix(family.name + sample.suffix, sample.labels)
+			if isinstance(sample.value, int):
+				line += "%i" % sample.value
+			else:
+				line += "%f" % sample.value
+			# OpenMetrics time stamps are in seconds
+			if sample.time_stamp is not None:
+				line += " %.3f" % ( sample.time_stamp / 1000 )
+			chunk.append(line + "\n")
+			size += len(line)
+
+		if size >= chunk_size:
+			write(bytes("".join(chunk), "utf8"))
+			chunk = []
+			size = 0
+
+	if chunk:
+		write(bytes("".join(chunk), "utf8"))
+
+#
+# Protobuf Encoding
+#
+
+# MetricType enum and the Metric field holding the value for each type, from
+# io.prometheus.client metrics.proto
+PROTOBUF_TYPES = {
+	'counter': ( 0, 3 ),
+	'gauge': ( 1, 2 ),
+	'untyped': ( 3, 5 ),
+	'histogram': ( 4, 7 ),
+}
+
+def encode_varint(value: int) -> bytes:
+	encoded = bytearray()
+	while value > 0x7f:
+		encoded.append(( value & 0x7f ) | 0x80)
+		value >>= 7
+	encoded.append(value)
+	return bytes(encoded)
+
+def encode_field(number: int, value) -> bytes:
+	"""
+	Encodes a protobuf field, bytes and strings as length delimited, floats
+	as double and ints as varint.
+
+	```
+	:return: The encoded field
+	:rtype: bytes
+	```
+	"""
+	if isinstance(value, str):
+		value = bytes(value, "utf8")
+	if isinstance(value, bytes):
+		return encode_varint(number << 3 | 2) + encode_varint(len(value)) + value
+	if isinstance(value, float):
+		return encode_varint(number << 3 | 1) + struct.pack('<d', value)
+	return encode_varint(number << 3) + encode_varint(value)
+
+@functools.lru_cache(maxsize=1024)
+def get_protobuf_header(name: str, type: str, unit: str, help: str) -> bytes:
+	"""
+	Gets the encoded name, help, type and unit fields of a MetricFamily
+	message, cached so scrapes only encode the samples.
+
+	```
+	:return: The encoded fields
+	:rtype: bytes
+	```
+	"""
+	header = encode_field(1, name)
+	if help is not None:
+		header += encode_field(2, help)
+	header += encode_field(3, PROTOBUF_TYPES.get(type, PROTOBUF_TYPES['untyped'])[0])
+	if unit is not None:
+		header += encode_field(5, unit)
+	return header
+
+@util.memoize(util.LABELS_CACHE_SIZE)
+def get_protobuf_labels(labels: tuple) -> bytes:
+	"""
+	Gets the encoded LabelPair fields of a Metric message, cached like the
+	text sample prefixes.
+
+	```
+	:return: The encoded fields
+	:rtype: bytes
+	```
+	"""
+	return b"".join(
+		encode_field(1, encode_field(1, label_name) + encode_field(2, str(label_value)))
+		for label_name, label_value in labels
+	)
+
+def encode_histograms(family: MetricFamily) -> list:
+	"""
+	Groups the `_bucket`, `_sum` and `_count` samples of a histogram family
+	into the fields of a Histogram message for each label set.
+
+	```
+	:return: Encoded Metric messages
+	:rtype: list
+	```
+	"""
+	histograms = {}
+	for sample in family.samples:
+		labels = tuple(label for label in sample.labels if label[0] != 'le')
+		histogram = histograms.setdefault(labels, [ b"", b"" ])
+
+		match sample.suffix:
+			case '_count':
+				histogram[0] = encode_field(1, int(sample.value)) + histogram[0]
+			case '_sum':
+				histogram[0] += encode_field(2, float(sample.value))
+			case '_bucket':
+				upper_bound = float(dict(sample.labels)['le'])
+				# +Inf is implied by the sample count
+				if upper_bound != float('inf'):
+					histogram[1] += encode_field(3,
+						encode_field(1, int(sample.value)) + encode_field(2, upper_bound)
+					)
+
+	return [
+		get_protobuf_labels(labels) + encode_field(7, fields + buckets)
+		for labels, ( fields, buckets ) in histograms.items()
+	]
+
+def encode_family(family: MetricFamily) -> bytes:
+	"""
+	Encodes a metric family as a MetricFamily message.
+
+	```
+	:return: The encoded message
+	:rtype: bytes
+	```
+	"""
+	message = get_protobuf_header(family.name, family.type, family.unit, family.help)
+
+	if family.type == 'histogram':
+		metrics = encode_histograms(family)
+	else:
+		value_field = PROTOBUF_TYPES.get(family.type, PROTOBUF_TYPES['untyped'])[1]
+		metrics = []
+		for sample in family.samples:
+			metric = get_protobuf_labels(sample.labels)
+			metric += encode_field(value_field, encode_field(1, float(sample.value)))
+			if sample.time_stamp is not None:
+				metric += encode_field(6, int(sample.time_stamp))
+			metrics.append(metric)
+
+	return message + b"".join(encode_field(4, metric) for metric in metrics)
+
+def write_protobuf(families: list, write, chunk_size: int = CHUNK_SIZE) -> None:
+	"""
+	Serializes metric families as length delimited protobuf MetricFamily
+	messages, passing them to `write` in chunks of about `chunk_size` bytes.
+	Families without samples are left out.
+
+	```
+	:return: None
+	:rtype: None
+	```
+	"""
+	chunk = []
+	size = 0
+
+	for family in families:
+		if not family.samples:
+			continue
+
+		message = encode_family(family)
+		chunk.append(encode_varint(len(message)) + message)
+		size += len(message)
+
+		if size >= chunk_size:
+			write(b"".join(chunk))
+			chunk = []
+			size = 0
+
+	if chunk:
+		write(b"".join(chunk))
+
+#
+# Configure Formats
+#
+
+# Content type, serializer and end of the exposition for each format
+FORMATS = {
+
+	'protobuf': {
+		'content_type': 'application/vnd.google.protobuf; proto=io.prometheus.client.MetricFamily; encoding=delimited',
+		'write': write_protobuf,
+		'eof': b"",
+	},
+
+	'openmetrics': {
+		'content_type': 'application/openmetrics-text; version=1.0.0; charset=utf-8',
+		'write': write_openmetrics,
+		'eof': b"# EOF\n",
+	},
+
+	'text': {
+		'content_type': 'text/plain; version=0.0.4; charset=utf-8',
+		'write': write_text,
+		'eof': b"# EOF\n",
+	},
+
+}
@@ -0,0 +1,196 @@
+"""
+History of recent upstream readings, kept in memory so derived metrics can be
+calculated inside the exporter.
+
+Readings are stored per (source, sensor, field) in ring buffers backed by
+arrays of doubles, 16 bytes a reading. Buffers grow with the readings they
+hold up to `history_size` readings, and all buffers together hold at most
+`history_max_readings` readings.
+"""
+
+import array
+import collections
+import logging
+import threading
+import time
+
+from iot_exporter import util
+
+_logger = logging.getLogger(__name__)
+_conf = util.get_conf()['DEFAULT']
+_series = collections.OrderedDict()
+_readings = 0
+_lock = threading.Lock()
+
+# Readings a buffer starts out with before growing
+INITIAL_SIZE = 16
+
+class Ring:
+	"""
+	Ring buffer of ( time stamp, value ) readings, doubling in size until it
+	holds `max_size` readings and overwriting the oldest reading from then on.
+	"""
+
+	__slots__ = ( 'times', 'values', 'next', 'count', 'max_size', 'updated' )
+
+	def __init__(self, max_size: int):
+		size = min(INITIAL_SIZE, max_size)
+		self.times = array.array('d', bytes(8 * size))
+		self.values = array.array('d', bytes(8 * size))
+		self.next = 0
+		self.count = 0
+		self.max_size = max_size
+		self.updated = time.time()
+
+	def get_growth(self) -> int:
+		"""
+		Gets the readings the buffer grows by with the next reading.
+
+		```
+		:return: Number of readings, 0 if it doesn't grow
+		:rtype: int
+		```
+		"""
+		if self.count < len(self.times):
+			return 0
+		return min(len(self.times), self.max_size - len(self.times))
+
+	def append(self, time_stamp: float, value: float, grow: bool = True) -> None:
+		growth = self.get_growth() if grow else 0
+		if growth:
+			# Buffers only grow before they wrap around, so the readings are
+			# in order and the next one goes right after them.
+			self.times.frombytes(bytes(8 * growth))
+			self.values.frombytes(bytes(8 * growth))
+			self.next = self.count
+
+		self.times[self.next] = time_stamp
+		self.values[self.next] = value
+		self.next = ( self.next + 1 ) % len(self.times)
+		self.count = min(self.count + 1, len(self.times))
+		self.updated = time.time()
+
+	def get_last_time(self) -> float:
+		if not self.count:
+			return 0
+		return self.times[self.next - 1]
+
+	def get(self) -> list:
+		"""
+		Gets all readings in the buffer.
+
+		```
+		:return: ( time stamp, value ) tuples, oldest first
+		:rtype: list
+		```
+		"""
+		start = ( self.next - self.count ) % len(self.times)
+		return [
+			( self.times[index % len(self.times)], self.values[index % len(self.times)] )
+			for index in range(start, start + self.count)
+		]
+
+def evict(needed: int) -> bool:
+	"""
+	Makes room for `needed` more readings by evicting series that got no new
+	readings for `cache_max_stale` seconds, least recently updated first.
+	Series that are still updated are never evicted, so they don't take turns
+	pushing each other out once the limit is reached. Must hold the lock.
+
+	```
+	:return: If there is room now
+	:rtype: bool
+	```
+	"""
+	global _readings
+
+	max_readings = int(_conf.get('history_max_readings'))
+	stale_before = time.time() - float(_conf.get('cache_max_stale'))
+
+	while _readings + needed > max_readings and _series:
+		key, ring = next(iter(_series.items()))
+		if ring.updated > stale_before:
+			return False
+		del _series[key]
+		_readings -= len(ring.times)
+
+	return _readings + needed <= max_readings
+
+def add(source: str, sensor, field: str, time_stamp: float, value: float) -> None:
+	"""
+	Adds a reading to the history of a field. Readings not newer than the last
+	one are skipped, so the same data can be added after every refresh. Once
+	`history_max_readings` readings are reached buffers stop growing, and new
+	series are only added after stale ones are evicted.
+
+	```
+	:return: None
+	:rtype: None
+	```
+	"""
+	global _readings
+
+	size = int(_conf.get('history_size'))
+	if size <= 0 or value is None:
+		return
+
+	key = ( source, str(sensor), field )
+	with _lock:
+		ring = _series.get(key)
+		if ring is not None and time_stamp <= ring.get_last_time():
+			return
+
+		if ring is None:
+			if not evict(min(INITIAL_SIZE, size)):
+				_logger.debug("Not keeping history for %s, history_max_readings is reached", key)
+				return
+			ring = _series[key] = Ring(size)
+			_readings += len(ring.times)
+			ring.append(time_stamp, float(value))
+		else:
+			# Buffers that can't grow overwrite their oldest reading instead,
+			# this series isn't stale so it's never evicted to make room.
+			ring.updated = time.time()
+			_series.move_to_end(key)
+			growth = ring.get_growth()
+			grow = bool(growth) and evict(growth)
+			if grow:
+				_readings += growth
+			ring.append(time_stamp, float(value), grow)
+		_series.move_to_end(key)
+
+def get(source: str, sensor, field: str) -> list:
+	"""
+	Gets the recent readings of a field.
+
+	```
+	:return: ( time stamp, value ) tuples, oldest first
+	:rtype: list
+	```
+	"""
+	with _lock:
+		ring = _series.get(( source, str(sensor), field ))
+		if ring is None:
+			return []
+		return ring.get()
+
+def dump(source: str = None) -> list:
+	"""
+	Gets the readings of every series, optionally of a single source.
+
+	```
+	:return: A dict with source, sensor, field and readings for each series
+	:rtype: list
+	```
+	"""
+	with _lock:
+		return [
+			{
+				'source': key[0],
+				'sensor': key[1],
+				'field': key[2],
+				'readings': ring.get(),
+			}
+			for key, ring in _series.items()
+			if source is None or key[0] == source
+		]
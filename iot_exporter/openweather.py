@@ -1,19 +1,15 @@
+import functools
 import logging
 import math
-import requests
-import time
+import typing
 
-from iot_exporter import util
+from iot_exporter import client, exposition, history, util
 
 _logger = logging.getLogger(__name__)
 _conf = util.get_conf()['openweather']
-_lat_lon = None
-_cache = {}
-_cache_count = {
-	'hit': 0,
-	'miss': 0,
-}
-_session = requests.Session()
+_cache = util.Cache('openweather')
+_generation = 0
+_session = client.Session('openweather')
 
 METRICS = {
 
@@ -81,58 +77,119 @@ METRICS = {
 
 }
 
-def get_lat_lon() -> dict:
-	global _lat_lon
+def get_setting(account_conf, key: str) -> str:
+	# Accounts fall back to the [openweather] section, e.g. for endpoints
+	return account_conf.get(key, fallback=_conf.get(key))
+
+def get_locations() -> list:
+	"""
+	Gets the configured locations of all accounts with an api_key. Locations
+	are zip and country codes like `01234,us` or coordinates like
+	`45.52,-122.68`, one per line of `locations`, or the older single `zip`
+	setting which takes precedence.
+
+	```
+	:return: A dict with the location, its account's config and zip or coordinates for each location
+	:rtype: list
+	```
+	"""
+	locations = {}
+
+	for account, account_conf in util.get_accounts('openweather'):
+		if not util.is_configured(account_conf):
+			_logger.debug("Skipping [%s], it has no api_key", account_conf.name)
+			continue
+
+		if account_conf.get('zip'):
+			lines = [ account_conf.get('zip') ]
+			if account_conf.get('locations', '').strip():
+				_logger.warning("Ignoring locations of [%s], zip is set as well", account_conf.name)
+		else:
+			lines = account_conf.get('locations', '').splitlines()
+
+		for line in lines:
+			line = line.strip()
+			if not line:
+				continue
+			if line in locations:
+				_logger.warning("Skipping location %s of account %s, it's already configured", line, account)
+				continue
 
-	if _lat_lon:
-		return _lat_lon
+			location = {
+				'location': line,
+				'account': account_conf,
+				'zip': None,
+				'lat': None,
+				'lon': None,
+			}
+			try:
+				location['lat'], location['lon'] = [ float(part) for part in line.split(',') ]
+			except ValueError:
+				location['zip'] = line
+			locations[line] = location
+
+	return list(locations.values())
+
+_locations = get_locations()
+
+def get_lat_lon(location: dict) -> dict:
+	"""
+	Geocodes the zip code of a location, results are cached for 30 days.
+
+	```
+	:return: Geocoding API response
+	:rtype: dict
+	```
+	"""
+	return _cache.get(
+		('lat_lon', location['zip']),
+		functools.partial(fetch_lat_lon, location),
+		60 * 60 * 24 * 30
+	)
 
+def fetch_lat_lon(location: dict) -> dict:
 	response = _session.get(
-		_conf.get('geo_endpoint'),
+		get_setting(location['account'], 'geo_endpoint'),
 		params = {
-			'zip': _conf.get('zip'),
-			'appid': _conf.get('api_key'),
+			'zip': location['zip'],
+			'appid': get_setting(location['account'], 'api_key'),
 		}
 	)
 
 	if response.status_code != 200:
-		raise RuntimeError(f'Could not geo locate the zip code {_conf.get('zip')}')
-
-	_lat_lon = response.json()
-	return _lat_lon
+		raise RuntimeError(f"Could not geo locate the zip code {location['zip']}")
 
-def query_api() -> dict:
-	global _cache
-	global _cache_count
+	return response.json()
 
-	if 'timestamp' not in _cache:
-		_cache = {
-			'timestamp': 0,
-			'data': {},
-		}
+def query_api(location: dict) -> dict:
+	return _cache.get(
+		('weather', location['location']),
+		functools.partial(fetch_weather, location),
+		int(get_setting(location['account'], 'api_cache_time'))
+	)
 
-	if time.time() - _cache['timestamp'] < int(_conf.get('api_cache_time')):
-		_cache_count['hit'] += 1
-		return _cache['data']
+def fetch_weather(location: dict) -> dict:
+	if location['zip'] is None:
+		lat_lon = location
 	else:
-		_cache['timestamp'] = time.time() # stampede protection
-
-	lat_lon = get_lat_lon()
+		lat_lon = get_lat_lon(location)
+		if lat_lon is None:
+			return None
 
-	_cache_count['miss'] += 1
 	response = _session.get(
-		_conf.get('api_endpoint'),
+		get_setting(location['account'], 'api_endpoint'),
 		params = {
 			'lat': lat_lon['lat'],
 			'lon': lat_lon['lon'],
-			'appid': _conf.get('api_key'),
+			'appid': get_setting(location['account'], 'api_key'),
 		}
 	)
 
-	if response.status_code == 200:
-		_cache['data'] = response.json()
+	if response.status_code != 200:
+		_logger.debug("Could not query current weather for %s", location['location'])
+		return None
 
-	return _cache['data']
+	return response.json()
 
 def get_value(data: dict, key: str):
 	key_parts = key.split('.')
@@ -143,64 +200,182 @@ def get_value(data: dict, key: str):
 		data_part = data_part[key_part]
 	return data_part
 
-def collect() -> list:
-	global _cache_count
-
-	data = query_api()
-	lat_lon = get_lat_lon()
+def update_history() -> None:
+	"""
+	Adds the latest raw weather readings of all locations to the history.
+
+	```
+	:return: None
+	:rtype: None
+	```
+	"""
+	for location in _locations:
+		data = _cache.peek(('weather', location['location']))
+		if data is None:
+			continue
+
+		for metric_def in METRICS.values():
+			for field_name in metric_def['fields'].keys():
+				history.add(
+					'openweather',
+					location['location'],
+					field_name,
+					data['dt'],
+					get_value(data, field_name)
+				)
 
-	output = []
+def get_data_age() -> float:
+	"""
+	Gets the seconds since the oldest exported weather data was fetched.
+
+	```
+	:return: Age of the exported data, None if there is no data yet
+	:rtype: float
+	```
+	"""
+	return _cache.get_age([ ('weather', location['location']) for location in _locations ])
+
+def get_generation() -> int:
+	"""
+	Gets a counter that goes up every time new upstream data arrived.
+
+	```
+	:return: The current generation of the exported data
+	:rtype: int
+	```
+	"""
+	return _generation
+
+def try_query_api(location: dict) -> Exception:
+	try:
+		query_api(location)
+	except Exception as e:
+		return e
+	return None
+
+def refresh() -> float:
+	"""
+	Fetches new data from the OpenWeather API, called in the background by the
+	scheduler.
+
+	```
+	:return: Seconds until the next refresh is needed
+	:rtype: float
+	```
+	"""
+	global _generation
+
+	version = _cache.get_version()
+	try:
+		_cache.retain(
+			[ ('weather', location['location']) for location in _locations ] +
+			[ ('lat_lon', location['zip']) for location in _locations if location['zip'] is not None ]
+		)
+
+		# Locations are fetched concurrently, a failing location doesn't hold
+		# up the others.
+		for location, error in zip(_locations, client.map('openweather', try_query_api, _locations)):
+			if error is not None:
+				_logger.warning("Could not refresh %s: %s", location['location'], error)
+		update_history()
+		_cache.save()
+	finally:
+		# Only render the exposition again once there is new data, request
+		# counts alone don't need a new render.
+		if _cache.get_version() != version:
+			_generation += 1
+
+	return _cache.next_expiry()
+
+def compile_metrics() -> dict:
+	"""
+	Compiles the configured metrics into the parts of the exposition that
+	don't change between scrapes, so collecting only has to add values.
+
+	```
+	:return: Label pairs and normalize function for each exported metric
+	:rtype: dict
+	```
+	"""
+	compiled = {}
 
-	# Metric fields
 	for metric_name, metric_def in METRICS.items():
-		for desc in [ 'TYPE', 'UNIT', 'HELP' ]:
-			if desc in metric_def:
-				output.append("# %s %s %s" % (
-					desc,
-					metric_name,
-					metric_def[desc]
-				))
-
-		for field_name, labels in metric_def['fields'].items():
-			value = get_value(data, field_name)
-			if value is None:
-				_logger.debug("Did not find a value for: %s", field_name)
-				continue
+		compiled[metric_name] = {
+			'fields': [
+				( field_name, tuple(labels.items()) )
+				for field_name, labels in metric_def['fields'].items()
+			],
+			'normalize': metric_def.get('normalize'),
+		}
 
-			# Add in location info
-			labels['name'] = lat_lon['name']
-			labels['zip'] = lat_lon['zip']
+	return compiled
+
+_compiled = compile_metrics()
+
+def collect() -> typing.Iterator[exposition.MetricFamily]:
+	"""
+	Collects the metrics from cached data, one metric family at a time.
+
+	```
+	:return: Metric families
+	:rtype: typing.Iterator[exposition.MetricFamily]
+	```
+	"""
+	# Location labels and data of each location that has data
+	located = []
+	for location in _locations:
+		data = _cache.peek(('weather', location['location']))
+		if data is None:
+			_logger.debug("Did not find data for: %s", location['location'])
+			continue
+
+		if location['zip'] is None:
+			location_labels = (
+				('name', data.get('name', '')),
+				('lat', location['lat']),
+				('lon', location['lon']),
+			)
+		else:
+			lat_lon = _cache.peek(('lat_lon', location['zip']))
+			if lat_lon is None:
+				continue
+			location_labels = (
+				('name', lat_lon['name']),
+				('zip', lat_lon['zip']),
+			)
+		located.append(( location_labels, data ))
 
-			# See if we need to normalize the value
-			if 'normalize' in metric_def:
-				value = metric_def['normalize'](
-					field_name,
-					value
+	# Metric fields
+	for metric_name, metric_def in METRICS.items():
+		compiled = _compiled[metric_name]
+		normalize = compiled['normalize']
+
+		family = exposition.MetricFamily(metric_name, metric_def)
+
+		for location_labels, data in located:
+			for field_name, labels in compiled['fields']:
+				value = get_value(data, field_name)
+				if value is None:
+					_logger.debug("Did not find a value for: %s", field_name)
+					continue
+
+				# See if we need to normalize the value
+				if normalize:
+					value = normalize(field_name, value)
+
+				family.add(
+					labels + location_labels,
+					float(value),
+					data['dt'] * 1000
 				)
 
-			output.append("%s{%s} %f %i" % (
-				metric_name,
-				util.to_label_param(labels),
-				value,
-				data['dt'] * 1000
-			))
-
-		output.append('')
+		yield family
 
 	# Meta stats fields
-	meta = 'openweather_api_requests_total'
-	output.append("# TYPE %s counter" % (meta))
-	output.append("# HELP %s Count of API requests made and skipped due to existing cache" % (meta))
-	output.append('%s{cache="%s"} %f' % (
-		meta,
-		'hit',
-		_cache_count['hit']
-	))
-	output.append('%s{cache="%s"} %f' % (
-		meta,
-		'miss',
-		_cache_count['miss']
-	))
-	output.append('')
-
-	return output
\ No newline at end of file
+	meta = exposition.MetricFamily('openweather_api_requests_total', {
+		'TYPE': 'counter',
+		'HELP': 'Count of API requests made and skipped due to existing cache',
+	})
+	meta.add((('cache', 'hit'),), float(_cache.counts['hit']))
+	meta.add((('cache', 'miss'),), float(_cache.counts['miss']))
+	yield meta
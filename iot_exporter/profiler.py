@@ -0,0 +1,149 @@
+"""
+Profiling of the live exporter process, so slow scrapes can be looked into
+without restarting and losing the warm in-memory caches.
+
+CPU profiles are taken by periodically sampling the stacks of all threads,
+which covers the scrape, collector and background refresh threads alike and
+costs nothing while no profile is running. Memory is profiled with
+tracemalloc once it's been asked for.
+"""
+
+import collections
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+_profile_lock = threading.Lock()
+_snapshot = None
+
+# Longest profile that can be asked for, a profile holds on to a server worker
+MAX_SECONDS = 60
+
+def get_frame_name(frame) -> str:
+	code = frame.f_code
+	return "%s (%s:%i)" % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno)
+
+def sample(seconds: float, interval: float = 0.01) -> collections.Counter:
+	"""
+	Samples the stacks of all other threads every `interval` seconds for
+	`seconds` seconds, at most MAX_SECONDS. Only one profile runs at a time.
+
+	```
+	:return: Number of samples of each stack, keyed by thread name and frame names outermost first
+	:rtype: collections.Counter
+	```
+	"""
+	if not _profile_lock.acquire(blocking=False):
+		raise RuntimeError('A profile is already running')
+
+	stacks = collections.Counter()
+	try:
+		own_thread = threading.get_ident()
+		until = time.monotonic() + min(seconds, MAX_SECONDS)
+		while time.monotonic() < until:
+			thread_names = { thread.ident: thread.name for thread in threading.enumerate() }
+			for thread_id, frame in sys._current_frames().items():
+				if thread_id == own_thread:
+					continue
+				stack = []
+				while frame is not None:
+					stack.append(get_frame_name(frame))
+					frame = frame.f_back
+				stack.append(thread_names.get(thread_id, str(thread_id)))
+				stacks[tuple(reversed(stack))] += 1
+			# Never sleep past the end, a long interval would hold the lock
+			time.sleep(max(0, min(max(interval, 0.001), until - time.monotonic())))
+	finally:
+		_profile_lock.release()
+
+	return stacks
+
+def get_collapsed(stacks: collections.Counter) -> str:
+	"""
+	Formats sampled stacks as collapsed stacks, one `frame;frame;frame count`
+	line per stack, as read by flamegraph.pl, speedscope and similar tools.
+
+	```
+	:return: The collapsed stacks
+	:rtype: str
+	```
+	"""
+	return "".join(
+		"%s %i\n" % (";".join(stack), count)
+		for stack, count in sorted(stacks.items())
+	)
+
+def get_stats(stacks: collections.Counter, limit: int = 50) -> str:
+	"""
+	Formats sampled stacks like pstats, with the samples each function was
+	running in itself and the samples it was anywhere on the stack, sorted by
+	the latter.
+
+	```
+	:return: A table of the `limit` functions with the most samples
+	:rtype: str
+	```
+	"""
+	total = sum(stacks.values())
+	own = collections.Counter()
+	cumulative = collections.Counter()
+	for stack, count in stacks.items():
+		# Skip the thread name, recursive functions only count once
+		frames = stack[1:]
+		if frames:
+			own[frames[-1]] += count
+		for frame in set(frames):
+			cumulative[frame] += count
+
+	lines = [
+		"%i samples\n\n" % total,
+		"%8s %8s %8s %8s  %s\n" % ('own', 'own%', 'cum', 'cum%', 'function'),
+	]
+	for frame, count in cumulative.most_common(limit):
+		lines.append("%8i %8.1f %8i %8.1f  %s\n" % (
+			own[frame],
+			100 * own[frame] / total,
+			count,
+			100 * count / total,
+			frame,
+		))
+	return "".join(lines)
+
+def get_tracemalloc(limit: int = 50) -> str:
+	"""
+	Takes a tracemalloc snapshot and lists the lines that allocated the most
+	memory still in use, and how that changed since the previous snapshot.
+	The first call starts tracing, which slows down allocations from then
+	on, so memory allocated before it isn't accounted for.
+
+	```
+	:return: A table of the `limit` lines using the most memory
+	:rtype: str
+	```
+	"""
+	global _snapshot
+
+	if not tracemalloc.is_tracing():
+		tracemalloc.start()
+		_snapshot = None
+		return "Started tracing memory allocations, get this page again for a snapshot\n"
+
+	snapshot = tracemalloc.take_snapshot().filter_traces((
+		tracemalloc.Filter(False, tracemalloc.__file__),
+	))
+	current, peak = tracemalloc.get_traced_memory()
+	lines = [ "%i bytes traced, %i bytes peak\n\n" % (current, peak) ]
+
+	if _snapshot is None:
+		lines.append("%12s %8s  %s\n" % ('size', 'count', 'line'))
+		for stat in snapshot.statistics('lineno')[:limit]:
+			lines.append("%12i %8i  %s\n" % (stat.size, stat.count, stat.traceback))
+	else:
+		lines.append("%12s %12s %8s  %s\n" % ('size', 'size diff', 'count', 'line'))
+		for stat in snapshot.compare_to(_snapshot, 'lineno')[:limit]:
+			lines.append("%12i %+12i %8i  %s\n" % (stat.size, stat.size_diff, stat.count, stat.traceback))
+
+	_snapshot = snapshot
+	return "".join(lines)
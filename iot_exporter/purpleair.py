@@ -1,18 +1,29 @@
+import functools
 import logging
 import math
-import requests
-import time
+import typing
 
-from iot_exporter import util
+from iot_exporter import aqi, client, exposition, history, store, util
+
+# NumPy is optional, normalizing whole columns of values at once is faster
+# with it but works the same without.
+try:
+	import numpy
+	minimum, log = numpy.minimum, numpy.log
+except ImportError:
+	numpy = None
+	minimum, log = min, math.log
 
 _logger = logging.getLogger(__name__)
 _conf = util.get_conf()['purpleair']
-_cache = {}
-_cache_count = {
-	'hit': 0,
-	'miss': 0,
+_cache = util.Cache('purpleair')
+_modified_since = store.load('purpleair.modified_since', 0)
+_nowcast = {
+	( sensor, field_name ): aqi.NowCast(state)
+	for sensor, field_name, state in store.load('purpleair.nowcast', [])
 }
-_session = requests.Session()
+_generation = 0
+_session = client.Session('purpleair')
 _session.headers.update({'X-API-Key': _conf.get('api_key')})
 
 #
@@ -58,7 +69,7 @@ METRICS = {
 			'humidity_b': {'channel': 'B'},
 		},
 		# Raw value is on average is 4% lower than ambient conditions
-		'normalize': lambda field, x : min( 1, x / 100 + 0.04 ),
+		'normalize': lambda field, x : minimum( 1, x / 100 + 0.04 ),
 	},
 
 	'purpleair_temperature_fahrenheit': {
@@ -137,7 +148,7 @@ METRICS = {
 			'0.3_um_count_a': {'channel': 'A'},
 			'0.3_um_count_b': {'channel': 'B'},
 		},
-		'normalize': lambda field, x : 10 * math.log( ( x * 0.0195 + 10 ) / 10 )
+		'normalize': lambda field, x : 10 * log( ( x * 0.0195 + 10 ) / 10 )
 	},
 
 	'purpleair_um_particles_per_100ml': {
@@ -191,56 +202,74 @@ METRICS = {
 
 }
 
+# Metrics calculated from the NowCast of a field over the last 12 hours of
+# readings rather than its current value.
+NOWCAST_METRICS = {
+
+	'purpleair_pm_nowcast_aqi': {
+		'HELP': 'US EPA AQI based on the NowCast of PM2.5 / PM10 particulate concentrations over the last 12 hours.',
+		'TYPE': 'gauge',
+		'fields': {
+			'pm2.5_alt_a': {'channel': 'A', 'pm': '2.5'},
+			'pm2.5_alt_b': {'channel': 'B', 'pm': '2.5'},
+			'pm10.0_a': {'channel': 'A', 'pm': '10.0'},
+			'pm10.0_b': {'channel': 'B', 'pm': '10.0'},
+		},
+	},
+
+}
+
+# Normalize functions get the field name and either a single value or, with
+# NumPy, an array of values for that field across all sensors. Only use
+# operators and the minimum() / log() functions above in them.
+
 #
 # Helper Functions
 #
 
-def calc_epa_aqi(field: str, value: float) -> float:
+@functools.lru_cache
+def get_pollutant(field: str) -> str:
 	"""
-	Calculates the US EPA AQI index for the given raw pollutant value based on:
-	https://www.airnow.gov/sites/default/files/2020-05/aqi-technical-assistance-document-sept2018.pdf
-
-	Currently only supports PM2.5 and PM10.
+	Gets the pollutant a PurpleAir field measures, as named by `aqi`.
 
 	```
-	:return: The US EPA AQI index
-	:rtype: float
+	:return: The pollutant
+	:rtype: str
 	```
 	"""
 	pollutant = field.upper().split('_')[0]
 	match pollutant:
 		case 'PM2.5':
-			breakpoint_pollutant = [ 12.0, 35.4, 55.4, 150.4, 250.4, 350.4, 500.4 ]
+			return 'PM2.5'
 		case 'PM10.0':
-			breakpoint_pollutant = [ 54, 154, 254, 354, 424, 504, 604 ]
-		case 'O3' | 'CO' | 'SO2' | 'NO2':
-			raise ValueError(f'{pollutant} is not currently supported.')
+			return 'PM10'
 		case _:
 			raise ValueError(f'{field} could not be parsed into a valid pollutant.')
 
-	breakpoint_aqi = [ 50, 100, 150, 200, 300, 400, 500 ]
-
-	# First clamp based on min and max
-	if value <= 0:
-		return 0;
-	if value >= breakpoint_pollutant[6]:
-		return breakpoint_aqi[6];
-
-	# Walk breakpoints and calculate based on ratios
-	for index, bp in enumerate(breakpoint_pollutant):
-		if value <= bp:
-			break;
+def calc_epa_aqi(field: str, value):
+	"""
+	Calculates the US EPA AQI index for the given raw pollutant value, or
+	array of values with NumPy.
 
-	i_lo = 0
-	bp_lo = 0
-	i_hi =  breakpoint_aqi[index]
-	bp_hi = breakpoint_pollutant[index]
+	```
+	:return: The US EPA AQI index
+	:rtype: float
+	```
+	"""
+	return aqi.calc_aqi(get_pollutant(field), value)
 
-	if index > 0:
-		i_lo =  breakpoint_aqi[index-1]
-		bp_lo = breakpoint_pollutant[index-1]
+def normalize_column(normalize, field: str, values: list) -> list:
+	"""
+	Normalizes the values of a field across all sensors in one pass.
 
-	return ( i_hi - i_lo ) / ( bp_hi - bp_lo ) * ( value - bp_lo ) + i_lo
+	```
+	:return: The normalized values
+	:rtype: list
+	```
+	"""
+	if numpy is not None:
+		return normalize(field, numpy.asarray(values, dtype=float)).tolist()
+	return [ normalize(field, value) for value in values ]
 
 def get_fields(query_type: str) -> list:
 	"""
@@ -251,11 +280,12 @@ def get_fields(query_type: str) -> list:
 	:rtype: list
 	```
 	"""
-	fields = []
+	# Multiple sensor queries only have a per sensor data time in last_seen
+	fields = ['last_seen']
 
 	match query_type:
 		case 'metrics':
-			for metric_name, metric_def in METRICS.items():
+			for metric_name, metric_def in ( METRICS | NOWCAST_METRICS ).items():
 				fields = list(set(fields + list(metric_def['fields'].keys())))
 		case 'info':
 			for info_name, info_fields in INFO_FIELDS.items():
@@ -265,179 +295,402 @@ def get_fields(query_type: str) -> list:
 
 	return fields
 
-def query_api(sensor: int, query_type: str) -> dict:
-	global _cache
-	global _cache_count
-
-	if sensor not in _cache:
-		_cache[sensor] = {
-			'metrics': {
-				'time_stamp': 0,
-			},
-			'info': {
-				'time_stamp': 0,
-			},
-		}
-
+def get_cache_ttl(query_type: str) -> int:
 	match query_type:
 		case 'metrics':
-			cache_ttl = int(_conf.get('api_cache_time'))
+			return int(_conf.get('api_cache_time'))
 		case 'info':
-			cache_ttl = 60 * 60 * 24 * 7
+			return 60 * 60 * 24 * 7
 		case _:
 			raise ValueError(f'{query_type} is not a valid query_type.')
 
+def query_api(sensors: list, query_type: str) -> None:
+	"""
+	Fetches data for all expired sensors from the PurpleAir multiple sensors
+	endpoint, in batches of `sensor_batch_size` sensors that are fetched
+	concurrently, and spreads the responses into the per sensor cache.
+
+	```
+	:return: None
+	:rtype: None
+	```
+	"""
+	global _modified_since
 
-	if time.time() - _cache[sensor][query_type]['time_stamp'] < cache_ttl:
-		_cache_count['hit'] += 1
-		return _cache[sensor][query_type]
-	else:
-		_cache[sensor][query_type]['time_stamp'] = time.time() # stampede protection
+	cache_ttl = get_cache_ttl(query_type)
 
-	# Test if we have new data first for metrics queries
-	if 'metrics' == query_type and 'data_time_stamp' in _cache[sensor]['metrics']:
-		data_time_stamp = 0
+	expired = [sensor for sensor in sensors if _cache.claim((sensor, query_type))]
+	_cache.counts['hit'] += len(sensors) - len(expired)
+
+	if not expired:
+		return
+
+	results = {}
+	try:
+		# Sensors we already have metrics for only need a refetch if they
+		# reported new data since our last query, let the API filter those out
+		# for us.
+		fresh = []
+		if 'metrics' == query_type and _modified_since:
+			fresh = [sensor for sensor in expired if _cache.peek((sensor, query_type))]
+		stale = [sensor for sensor in expired if sensor not in fresh]
+
+		batch_size = int(_conf.get('sensor_batch_size'))
+		batches = [
+			( group[i:i + batch_size], modified_since )
+			for group, modified_since in ( (fresh, _modified_since), (stale, 0) )
+			for i in range(0, len(group), batch_size)
+		]
+		_cache.counts['miss'] += len(batches)
+
+		time_stamps = []
+		responses = client.map('purpleair', lambda batch : fetch_sensors(query_type, *batch), batches)
+		for ( batch, modified_since ), response in zip(batches, responses):
+			if response is None:
+				time_stamps = None
+				continue
+			if time_stamps is not None:
+				time_stamps.append(response[0])
+
+			returned = response[1]
+			if modified_since:
+				for sensor in batch:
+					if sensor not in returned:
+						_cache.counts['hit'] += 1
+						returned[sensor] = _cache.peek((sensor, query_type))
+			results.update(returned)
+
+		# Only move on once every batch got its data, from the oldest response
+		# so no sensor misses an update.
+		if 'metrics' == query_type and time_stamps and (fresh or not _modified_since):
+			_modified_since = min(time_stamps)
+	finally:
+		# Release every claimed sensor, failed ones back off before retrying
+		for sensor in expired:
+			if results.get(sensor) is None:
+				_cache.fail((sensor, query_type))
+			else:
+				_cache.set((sensor, query_type), results[sensor], cache_ttl)
+
+def fetch_sensors(query_type: str, sensors: list, modified_since: int = 0) -> tuple:
+	"""
+	Queries the PurpleAir multiple sensors endpoint for the given sensors. With
+	`modified_since` only sensors that have new data since that time are
+	returned by the API.
 
-		_cache_count['miss'] += 1
+	```
+	:return: Time stamp of the response and data by sensor, or None if the query failed
+	:rtype: tuple
+	```
+	"""
+	params = {
+		'show_only': ','.join(str(sensor) for sensor in sensors),
+		'fields': ','.join(get_fields(query_type)),
+		# Include sensors regardless of when they last reported
+		'max_age': 0,
+	}
+	if modified_since:
+		params['modified_since'] = modified_since
+
+	try:
 		response = _session.get(
-			f"{_conf.get('api_endpoint')}/{sensor}",
-			params = {
-				'fields': 'confidence',
-			}
+			_conf.get('api_endpoint'),
+			params = params
 		)
+	except Exception:
+		_logger.exception("Could not query %s for sensors: %s", query_type, sensors)
+		return None
+
+	if response.status_code != 200:
+		_logger.debug("Could not query %s for sensors: %s", query_type, sensors)
+		return None
+
+	response_data = response.json()
+	returned = {}
+	for row in response_data['data']:
+		sensor_data = dict(zip(response_data['fields'], row))
+		sensor = sensor_data['sensor_index']
+
+		if sensor not in sensors:
+			_logger.debug("Got data for a sensor we did not ask for: %s", sensor)
+			continue
+
+		returned[sensor] = {
+			'data_time_stamp': sensor_data.get('last_seen') or response_data['data_time_stamp'],
+			'sensor': sensor_data,
+		}
 
-		if response.status_code == 200:
-			response_data = response.json()
-			data_time_stamp = int(response_data['data_time_stamp'])
+	return ( response_data['time_stamp'], returned )
 
-		if data_time_stamp <= _cache[sensor]['metrics']['data_time_stamp']:
-			_cache_count['hit'] += 1
-			return _cache[sensor]['metrics']
+def get_cached(sensor: int, query_type: str) -> dict:
+	"""
+	Gets the last fetched data for a sensor without calling the PurpleAir API.
 
-	_cache_count['miss'] += 1
-	response = _session.get(
-		f"{_conf.get('api_endpoint')}/{sensor}",
-		params = {
-			'fields': ','.join(get_fields(query_type)),
-		}
-	)
+	```
+	:return: Cached API response, empty if nothing has been fetched yet
+	:rtype: dict
+	```
+	"""
+	return _cache.peek((sensor, query_type)) or {}
 
-	if response.status_code == 200:
-		_cache[sensor][query_type] = response.json()
+def compile_metrics() -> dict:
+	"""
+	Compiles the configured metrics into the parts of the exposition that
+	don't change between scrapes, so collecting only has to add values.
 
-	return _cache[sensor][query_type]
+	```
+	:return: Label pairs and normalize function for each exported metric
+	:rtype: dict
+	```
+	"""
+	compiled = {}
+
+	for metric_name, metric_def in ( METRICS | NOWCAST_METRICS ).items():
+		compiled[metric_name] = {
+			'fields': [
+				( field_name, tuple(labels.items()) )
+				for field_name, labels in metric_def['fields'].items()
+			],
+			'normalize': metric_def.get('normalize'),
+		}
 
-def collect_sensor(sensor: int, exposition: dict) -> None:
-	data = query_api(sensor, 'metrics')
+	return compiled
 
-	if 'time_stamp' not in data or 'sensor' not in data:
-		return
+_compiled = compile_metrics()
 
-	# Metric fields
-	for metric_name, metric_def in METRICS.items():
-		for field_name, labels in metric_def['fields'].items():
-			if field_name not in data['sensor']:
+def collect_metric(metric_name: str, cached: dict) -> exposition.MetricFamily:
+	"""
+	Collects a metric for all sensors with cached metrics, normalizing each
+	field as one column of values across all sensors.
+
+	```
+	:return: The metric family
+	:rtype: exposition.MetricFamily
+	```
+	"""
+	compiled = _compiled[metric_name]
+
+	columns = {}
+	for field_name, labels in compiled['fields']:
+		column = {}
+		for sensor, data in cached.items():
+			value = data['sensor'].get(field_name)
+			if value is None:
 				_logger.debug("Did not find a value for: %s", field_name)
 				continue
+			column[sensor] = value
+
+		if compiled['normalize'] and column:
+			column = dict(zip(
+				column.keys(),
+				normalize_column(compiled['normalize'], field_name, list(column.values()))
+			))
+		columns[field_name] = column
+
+	family = exposition.MetricFamily(metric_name, METRICS[metric_name])
+	for sensor, data in cached.items():
+		time_stamp = data['data_time_stamp'] * 1000
+
+		for field_name, labels in compiled['fields']:
+			if sensor not in columns[field_name]:
+				continue
 
 			# Add in sensor id
-			labels['sensor'] = sensor
-
-			# See if we need to normalize the value
-			if 'normalize' in metric_def:
-				value = metric_def['normalize'](
-					field_name,
-					data['sensor'][field_name]
-				)
-			else:
-				value = data['sensor'][field_name]
+			family.add(
+				labels + (('sensor', sensor),),
+				float(columns[field_name][sensor]),
+				time_stamp
+			)
 
-			if metric_name not in exposition:
-				exposition[metric_name] = []
+	return family
 
-			exposition[metric_name].append("%s{%s} %f %i" % (
-				metric_name,
-				util.to_label_param(labels),
-				value,
-				data['data_time_stamp'] * 1000
-			))
+def update_nowcast(sensors: list) -> None:
+	"""
+	Adds the latest readings of all sensors to their NowCast, readings that
+	were already added before are skipped.
 
-	data = query_api(sensor, 'info')
+	```
+	:return: None
+	:rtype: None
+	```
+	"""
+	for sensor in sensors:
+		data = get_cached(sensor, 'metrics')
+		if 'sensor' not in data:
+			continue
+
+		for metric_def in NOWCAST_METRICS.values():
+			for field_name in metric_def['fields'].keys():
+				value = data['sensor'].get(field_name)
+				if value is None:
+					continue
+				if ( sensor, field_name ) not in _nowcast:
+					_nowcast[( sensor, field_name )] = aqi.NowCast()
+				_nowcast[( sensor, field_name )].add(data['data_time_stamp'], value)
+
+def update_history(sensors: list) -> None:
+	"""
+	Adds the latest raw readings of all sensors to the history.
 
-	if 'time_stamp' not in data or 'sensor' not in data:
-		return
+	```
+	:return: None
+	:rtype: None
+	```
+	"""
+	fields = [ field_name for field_name in get_fields('metrics') if field_name != 'last_seen' ]
+
+	for sensor in sensors:
+		data = get_cached(sensor, 'metrics')
+		if 'sensor' not in data:
+			continue
+
+		for field_name in fields:
+			history.add(
+				'purpleair',
+				sensor,
+				field_name,
+				data['data_time_stamp'],
+				data['sensor'].get(field_name)
+			)
+
+def collect_nowcast(metric_name: str, sensors: list) -> exposition.MetricFamily:
+	family = exposition.MetricFamily(metric_name, NOWCAST_METRICS[metric_name])
+
+	for sensor in sensors:
+		for field_name, labels in _compiled[metric_name]['fields']:
+			nowcast = _nowcast.get(( sensor, field_name ))
+			if nowcast is None:
+				continue
 
-	# Info fields
-	for info_name, info_fields in INFO_FIELDS.items():
-		labels = {
-			'sensor': sensor,
-		}
-		for field_name in info_fields:
-			if field_name not in data['sensor']:
-				_logger.debug("Did not find a value for: %s", field_name)
+			value = nowcast.get()
+			if value is None:
+				_logger.debug("Not enough readings for a NowCast of: %s", field_name)
 				continue
-			labels[field_name] = data['sensor'][field_name]
 
-		if info_name not in exposition:
-			exposition[info_name] = []
+			family.add(
+				labels + (('sensor', sensor),),
+				float(aqi.calc_aqi(get_pollutant(field_name), value)),
+				nowcast.time_stamp * 1000
+			)
+
+	return family
+
+def collect_info(info_name: str, sensors: list) -> exposition.MetricFamily:
+	family = exposition.MetricFamily(info_name, {'TYPE': 'gauge'})
+
+	for sensor in sensors:
+		data = get_cached(sensor, 'info')
+		if 'sensor' not in data:
+			continue
 
-		exposition[info_name].append("%s{%s} %f %i" % (
-			info_name,
-			util.to_label_param(labels),
-			1,
+		labels = [
+			('sensor', sensor),
+		]
+		for field_name in INFO_FIELDS[info_name]:
+			if data['sensor'].get(field_name) is None:
+				_logger.debug("Did not find a value for: %s", field_name)
+				continue
+			labels.append((field_name, data['sensor'][field_name]))
+
+		family.add(
+			tuple(labels),
+			1.0,
 			data['data_time_stamp'] * 1000
-		))
+		)
 
-def collect() -> list:
-	global _cache_count
+	return family
 
-	exposition={}
-	for sensor in _conf.get('sensor_ids').split(','):
-		collect_sensor(int(sensor), exposition)
+def get_data_age() -> float:
+	"""
+	Gets the seconds since the oldest exported sensor metrics were fetched.
+
+	```
+	:return: Age of the exported data, None if there is no data yet
+	:rtype: float
+	```
+	"""
+	return _cache.get_age([ (int(sensor), 'metrics') for sensor in _conf.get('sensor_ids').split(',') ])
 
-	output = []
+def get_generation() -> int:
+	"""
+	Gets a counter that goes up every time new upstream data arrived.
 
-	# Info fields
-	for info_name in INFO_FIELDS.keys():
-		if info_name not in exposition:
-			exposition[info_name] = []
+	```
+	:return: The current generation of the exported data
+	:rtype: int
+	```
+	"""
+	return _generation
+
+def refresh() -> float:
+	"""
+	Fetches new data from the PurpleAir API for all configured sensors, called
+	in the background by the scheduler.
+
+	```
+	:return: Seconds until the next refresh is needed
+	:rtype: float
+	```
+	"""
+	global _generation
+
+	version = _cache.get_version()
+	try:
+		sensors = [int(sensor) for sensor in _conf.get('sensor_ids').split(',')]
+		_cache.retain([ (sensor, query_type) for sensor in sensors for query_type in ( 'metrics', 'info' ) ])
+		query_api(sensors, 'metrics')
+		query_api(sensors, 'info')
+		update_nowcast(sensors)
+		update_history(sensors)
+
+		_cache.save()
+		store.save('purpleair.modified_since', _modified_since)
+		store.save('purpleair.nowcast', [
+			[ sensor, field_name, nowcast.get_state() ]
+			for ( sensor, field_name ), nowcast in _nowcast.items()
+			if sensor in sensors
+		])
+	finally:
+		# Only render the exposition again once there is new data, request
+		# counts alone don't need a new render.
+		if _cache.get_version() != version:
+			_generation += 1
+
+	return _cache.next_expiry()
+
+def collect() -> typing.Iterator[exposition.MetricFamily]:
+	"""
+	Collects the metrics of all configured sensors from cached data, one
+	metric family at a time.
 
-		output.append("# TYPE %s gauge" % (
-			info_name
-		))
+	```
+	:return: Metric families
+	:rtype: typing.Iterator[exposition.MetricFamily]
+	```
+	"""
+	sensors = [int(sensor) for sensor in _conf.get('sensor_ids').split(',')]
+
+	cached = {}
+	for sensor in sensors:
+		data = get_cached(sensor, 'metrics')
+		if 'sensor' in data:
+			cached[sensor] = data
 
-		output += exposition[info_name]
-		output.append('')
+	# Info fields, only for sensors that have metrics
+	for info_name in INFO_FIELDS.keys():
+		yield collect_info(info_name, list(cached.keys()))
 
 	# Metric fields
-	for metric_name, metric_def in METRICS.items():
-		if metric_name not in exposition:
-			exposition[metric_name] = []
-
-		for desc in [ 'TYPE', 'UNIT', 'HELP' ]:
-			if desc in metric_def:
-				output.append("# %s %s %s" % (
-					desc,
-					metric_name,
-					metric_def[desc]
-				))
-		output += exposition[metric_name]
-		output.append('')
+	for metric_name in METRICS.keys():
+		yield collect_metric(metric_name, cached)
+	for metric_name in NOWCAST_METRICS.keys():
+		yield collect_nowcast(metric_name, sensors)
 
 	# Meta stats fields
-	meta = 'purpleair_api_requests_total'
-	output.append("# TYPE %s counter" % (meta))
-	output.append("# HELP %s Count of API requests made and skipped due to existing cache" % (meta))
-	output.append('%s{cache="%s"} %f' % (
-		meta,
-		'hit',
-		_cache_count['hit']
-	))
-	output.append('%s{cache="%s"} %f' % (
-		meta,
-		'miss',
-		_cache_count['miss']
-	))
-	output.append('')
-
-	return output
+	meta = exposition.MetricFamily('purpleair_api_requests_total', {
+		'TYPE': 'counter',
+		'HELP': 'Count of API requests made and skipped due to existing cache',
+	})
+	meta.add((('cache', 'hit'),), float(_cache.counts['hit']))
+	meta.add((('cache', 'miss'),), float(_cache.counts['miss']))
+	yield meta
@@ -0,0 +1,147 @@
+"""
+Registry of the collectors the exporter can run, the built-in ones and any
+installed packages provide through the `iot_exporter.collectors` entry point
+group, e.g. in-house sensors:
+
+```
+[project.entry-points."iot_exporter.collectors"]
+acme = "acme_exporter.collector"
+```
+
+A collector is a module, or any object, with the functions:
+
+ - `refresh()` fetching new data, called in the background by the scheduler
+   every `api_cache_time` seconds of the collector's config section. Returns
+   the seconds until it needs to run again if that is sooner, or None.
+ - `collect()` yielding the `exposition.MetricFamily` of its cached data.
+ - `get_generation()` returning a counter that goes up whenever the exported
+   data may have changed.
+ - `get_data_age()` returning the seconds since its oldest exported data was
+   fetched, or None without data.
+ - Optionally `get_jobs()` returning more ( name, function, interval )
+   background jobs.
+
+Collectors are only imported when enabled, as importing them reads their
+config and sets up sessions.
+"""
+
+import functools
+import importlib
+import importlib.metadata
+import logging
+
+from iot_exporter import scheduler, util
+
+_logger = logging.getLogger(__name__)
+_conf = util.get_conf()
+_loaded = None
+
+ENTRY_POINT_GROUP = 'iot_exporter.collectors'
+
+# Module of each built-in collector, in the order they are exported
+BUILTIN = {
+	'purpleair': 'iot_exporter.purpleair',
+	'openweather': 'iot_exporter.openweather',
+	'beestat': 'iot_exporter.beestat',
+}
+
+# Functions every collector has
+INTERFACE = [ 'refresh', 'collect', 'get_generation', 'get_data_age' ]
+
+# Seconds between refreshes of collectors that don't set api_cache_time
+DEFAULT_INTERVAL = 60
+
+def get_available() -> dict:
+	"""
+	Gets all known collectors without importing them, built-in collectors
+	can't be replaced by entry points.
+
+	```
+	:return: Function importing the collector for each collector name
+	:rtype: dict
+	```
+	"""
+	available = {
+		name: functools.partial(importlib.import_module, module)
+		for name, module in BUILTIN.items()
+	}
+
+	for entry_point in sorted(importlib.metadata.entry_points(group=ENTRY_POINT_GROUP), key=lambda entry_point : entry_point.name):
+		if entry_point.name in available:
+			_logger.warning("Ignoring collector %s from %s, a collector of that name already exists", entry_point.name, entry_point.value)
+			continue
+		available[entry_point.name] = entry_point.load
+
+	return available
+
+def is_enabled(name: str) -> bool:
+	"""
+	Checks if a collector should run. Collectors need a config section of
+	their name, with `enabled = auto` they run once the `api_key` of that or
+	any `[name:<account>]` section is no longer the REPLACE_ME placeholder.
+
+	```
+	:return: If the collector is enabled
+	:rtype: bool
+	```
+	"""
+	if not _conf.has_section(name):
+		return False
+
+	section = _conf[name]
+	if section.get('enabled', 'auto').lower() == 'auto':
+		return any(util.is_configured(account_conf) for _, account_conf in util.get_accounts(name))
+	return section.getboolean('enabled')
+
+def load() -> dict:
+	"""
+	Imports the enabled collectors, once.
+
+	```
+	:return: The collector for each enabled collector name
+	:rtype: dict
+	```
+	"""
+	global _loaded
+
+	if _loaded is not None:
+		return _loaded
+
+	loaded = {}
+	for name, load_collector in get_available().items():
+		if not is_enabled(name):
+			_logger.info("Collector %s is not enabled", name)
+			continue
+
+		collector = load_collector()
+		missing = [ function for function in INTERFACE if not hasattr(collector, function) ]
+		if missing:
+			raise TypeError(f"Collector {name} is missing {', '.join(missing)}")
+		loaded[name] = collector
+		_logger.info("Loaded collector %s", name)
+
+	if not loaded:
+		_logger.warning("No collectors are enabled, configure at least one api_key")
+
+	_loaded = loaded
+	return _loaded
+
+def schedule() -> None:
+	"""
+	Registers the background refresh and other jobs of the enabled
+	collectors with the scheduler.
+
+	```
+	:return: None
+	:rtype: None
+	```
+	"""
+	for name, collector in load().items():
+		scheduler.register(
+			name,
+			collector.refresh,
+			_conf[name].getint('api_cache_time', fallback=DEFAULT_INTERVAL)
+		)
+
+		for job_name, function, interval in getattr(collector, 'get_jobs', list)():
+			scheduler.register(job_name, function, interval, name)
@@ -0,0 +1,96 @@
+"""
+Background refresh of upstream API data so that scrapes only read from memory.
+"""
+
+import logging
+import threading
+import time
+
+from iot_exporter import util
+
+_logger = logging.getLogger(__name__)
+_jobs = []
+_stop = threading.Event()
+
+def register(name: str, refresh, interval: float, collector: str = None) -> None:
+	"""
+	Registers a refresh function to be called every `interval` seconds once the
+	scheduler is started. Refresh functions may return the seconds until they
+	need to run again if that is sooner. Durations are recorded by job name
+	and the `collector` the job belongs to, by default the one of the same
+	name.
+
+	```
+	:return: None
+	:rtype: None
+	```
+	"""
+	_jobs.append({
+		'name': name,
+		'collector': collector or name,
+		'refresh': refresh,
+		'interval': interval,
+		'thread': None,
+		'ready': threading.Event(),
+	})
+
+def run_job(job: dict) -> None:
+	while not _stop.is_set():
+		delay = None
+
+		start = time.perf_counter()
+		try:
+			delay = job['refresh']()
+		except Exception:
+			_logger.exception("Background refresh failed for: %s", job['name'])
+		util.record(
+			'iot_exporter_refresh_duration_seconds',
+			(('collector', job['collector']), ('job', job['name'])),
+			time.perf_counter() - start
+		)
+		job['ready'].set()
+
+		# Refreshes may ask to run again sooner, e.g. to retry a failed API
+		# request after backing off, but never more than once a second.
+		if delay is None:
+			delay = job['interval']
+		_stop.wait(max(1, min(delay, job['interval'])))
+
+def start() -> None:
+	"""
+	Starts one daemon thread per registered job, each job runs its first
+	refresh right away to warm up the caches.
+
+	```
+	:return: None
+	:rtype: None
+	```
+	"""
+	for job in _jobs:
+		if job['thread'] is not None:
+			continue
+
+		job['thread'] = threading.Thread(
+			target=run_job,
+			args=(job,),
+			name=f"refresh-{job['name']}",
+			daemon=True,
+		)
+		job['thread'].start()
+
+def wait(name: str, timeout: float) -> bool:
+	"""
+	Waits up to `timeout` seconds for the first refresh of a job to finish.
+
+	```
+	:return: If the job has refreshed at least once
+	:rtype: bool
+	```
+	"""
+	for job in _jobs:
+		if job['name'] == name:
+			return job['ready'].wait(max(0, timeout))
+	return False
+
+def stop() -> None:
+	_stop.set()
@@ -0,0 +1,592 @@
+"""
+HTTP server exposing the metrics of all exporters to Prometheus.
+"""
+
+import concurrent.futures
+import contextlib
+import http.server
+import json
+import logging
+import math
+import select
+import socketserver
+import threading
+import time
+import typing
+import urllib.parse
+import zlib
+
+from iot_exporter import exposition, history, profiler, registry, scheduler, util
+
+_logger = logging.getLogger(__name__)
+_conf = util.get_conf()['DEFAULT']
+_collectors = registry.load()
+_rendered = {}
+_executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix='collect')
+
+# Bytes of text to gather before sending a chunk when streaming
+STREAM_CHUNK_SIZE = 8 * 1024
+
+# Seconds before its deadline a collector stops waiting for the first refresh,
+# leaving time to collect what it has before the scrape gives up on it
+WAIT_MARGIN = 0.5
+
+METRICS = {
+
+	'iot_exporter_collector_up': {
+		'TYPE': 'gauge',
+		'HELP': 'If the collector finished within its collector_timeout, late collectors are left out of the scrape.',
+	},
+
+	'iot_exporter_data_age_seconds': {
+		'TYPE': 'gauge',
+		'UNIT': 'seconds',
+		'HELP': 'Time since the oldest exported upstream data of the collector was fetched.',
+	},
+
+}
+
+def get_encoding(accept_encoding: str) -> str:
+	"""
+	Picks the content encoding for the response based on the Accept-Encoding
+	request header, preferring gzip over deflate.
+
+	```
+	:return: One of gzip, deflate or identity
+	:rtype: str
+	```
+	"""
+	accepted = {}
+	for coding in accept_encoding.split(','):
+		coding, _, params = coding.partition(';')
+		quality = 1.0
+		params = params.strip()
+		if params.startswith('q='):
+			try:
+				quality = float(params[2:])
+			except ValueError:
+				quality = 0.0
+		accepted[coding.strip().lower()] = quality
+
+	for encoding in [ 'gzip', 'deflate' ]:
+		if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+			return encoding
+	return 'identity'
+
+def get_format(accept: str) -> str:
+	"""
+	Picks the exposition format for the response based on the Accept request
+	header, preferring protobuf over OpenMetrics over the classic text format
+	when they are equally accepted.
+
+	```
+	:return: One of protobuf, openmetrics or text
+	:rtype: str
+	```
+	"""
+	accepted = {}
+	for media_range in accept.split(','):
+		media_type, *params = [ part.strip() for part in media_range.split(';') ]
+		params = dict(param.partition('=')[::2] for param in params)
+
+		try:
+			quality = float(params.get('q', 1.0))
+		except ValueError:
+			quality = 0.0
+
+		match media_type.lower():
+			case 'application/vnd.google.protobuf' if params.get('proto') == 'io.prometheus.client.MetricFamily' and params.get('encoding') == 'delimited':
+				format = 'protobuf'
+			case 'application/openmetrics-text' if params.get('version', '1.0.0') == '1.0.0':
+				format = 'openmetrics'
+			case 'text/plain' | 'text/*' | '*/*':
+				format = 'text'
+			case _:
+				continue
+		accepted[format] = max(quality, accepted.get(format, 0.0))
+
+	best = 'text'
+	for format in [ 'protobuf', 'openmetrics' ]:
+		if accepted.get(format, 0.0) > accepted.get(best, 0.0):
+			best = format
+	return best
+
+def get_collector_deadline(name: str, start: float, deadline: float = None) -> float:
+	"""
+	Gets the time by which a collector has to finish, `collector_timeout`
+	after the scrape started or the scrape deadline if that is sooner.
+
+	```
+	:return: Deadline as a unix time stamp
+	:rtype: float
+	```
+	"""
+	collector_deadline = start + float(util.get_conf()[name].get('collector_timeout'))
+	if deadline is not None:
+		collector_deadline = min(collector_deadline, deadline)
+	return collector_deadline
+
+def wait_ready(name: str, timeout: float) -> bool:
+	"""
+	Right after a start waits up to `timeout` seconds for the first refresh of
+	a collector rather than exporting nothing. Collectors with data, e.g.
+	restored from the cache file, are served from memory right away.
+
+	```
+	:return: If the collector has data to export
+	:rtype: bool
+	```
+	"""
+	if _collectors[name].get_data_age() is not None:
+		return True
+	return scheduler.wait(name, timeout)
+
+def run_collector(name: str, deadline: float) -> list:
+	wait_ready(name, deadline - WAIT_MARGIN - time.time())
+
+	start = time.perf_counter()
+	output = list(_collectors[name].collect())
+	util.record(
+		'iot_exporter_collect_duration_seconds',
+		(('collector', name),),
+		time.perf_counter() - start
+	)
+	return output
+
+def collect(names: tuple, deadline: float = None) -> tuple:
+	"""
+	Runs the named collectors concurrently, each up to its own
+	`collector_timeout` or the scrape `deadline` if that is sooner, and adds an
+	up metric for each of them.
+
+	```
+	:return: Metric families and if all collectors finished in time
+	:rtype: tuple
+	```
+	"""
+	start = time.time()
+	futures = {}
+	for name in names:
+		collector_deadline = get_collector_deadline(name, start, deadline)
+		futures[name] = ( collector_deadline, _executor.submit(run_collector, name, collector_deadline) )
+
+	output = []
+	up = []
+	for name, ( collector_deadline, future ) in futures.items():
+		try:
+			output += future.result(timeout=max(0, collector_deadline - time.time()))
+			up.append(1)
+		except concurrent.futures.TimeoutError:
+			_logger.warning("Collector %s did not finish in time", name)
+			up.append(0)
+		except Exception:
+			_logger.exception("Collector %s failed", name)
+			up.append(0)
+
+	family = exposition.MetricFamily('iot_exporter_collector_up', METRICS['iot_exporter_collector_up'])
+	for name, value in zip(names, up):
+		family.add((('collector', name),), value)
+	output.append(family)
+
+	return output, all(up)
+
+def collect_data_age(names: tuple) -> exposition.MetricFamily:
+	"""
+	Gets the age of the data each collector exports, rendered with every
+	scrape as it keeps changing while bodies are reused.
+
+	```
+	:return: Metric family
+	:rtype: exposition.MetricFamily
+	```
+	"""
+	family = exposition.MetricFamily('iot_exporter_data_age_seconds', METRICS['iot_exporter_data_age_seconds'])
+	for name in names:
+		age = _collectors[name].get_data_age()
+		if age is not None:
+			family.add((('collector', name),), float(age))
+	return family
+
+def stream(names: tuple, deadline: float = None) -> typing.Iterator[exposition.MetricFamily]:
+	"""
+	Collects the named collectors one after another, yielding each metric
+	family as soon as it is ready, followed by the up, data age and
+	instrumentation metrics. Collectors without data that have not refreshed
+	yet by their deadline are left out.
+
+	```
+	:return: Metric families
+	:rtype: typing.Iterator[exposition.MetricFamily]
+	```
+	"""
+	start = time.time()
+	up = exposition.MetricFamily('iot_exporter_collector_up', METRICS['iot_exporter_collector_up'])
+
+	for name in names:
+		if not wait_ready(name, get_collector_deadline(name, start, deadline) - time.time()):
+			_logger.warning("Collector %s did not finish in time", name)
+			up.add((('collector', name),), 0)
+			continue
+
+		collect_start = time.perf_counter()
+		try:
+			yield from _collectors[name].collect()
+			up.add((('collector', name),), 1)
+		except Exception:
+			_logger.exception("Collector %s failed", name)
+			up.add((('collector', name),), 0)
+		util.record(
+			'iot_exporter_collect_duration_seconds',
+			(('collector', name),),
+			time.perf_counter() - collect_start
+		)
+
+	yield up
+	yield collect_data_age(names)
+	yield from util.collect_instrumentation(names)
+
+def get_compressor(encoding: str):
+	"""
+	Creates a compressor for a content encoding.
+
+	```
+	:return: The compressor, None for identity
+	:rtype: zlib.Compress
+	```
+	"""
+	match encoding:
+		case 'gzip':
+			return zlib.compressobj(wbits=31)
+		case 'deflate':
+			return zlib.compressobj()
+		case 'identity':
+			return None
+		case _:
+			raise ValueError(f'{encoding} is not a supported encoding.')
+
+def render(names: tuple, format: str = 'text', encoding: str = 'identity', deadline: float = None) -> bytes:
+	"""
+	Renders the exposition of the named exporters as the response body. The
+	collected metric families, and the encoded body and compressor state for
+	each format and encoding, are kept and reused for as long as none of these
+	exporters got new data and all of them finished in time. Only data ages
+	and instrumentation metrics at the end are rendered and compressed per
+	scrape. Collectors are waited on until the `deadline` at most.
+
+	```
+	:return: The encoded exposition
+	:rtype: bytes
+	```
+	"""
+	write = exposition.FORMATS[format]['write']
+
+	# Read generations before collecting, if an exporter refreshes while we
+	# render the next scrape simply renders again.
+	generation = tuple(_collectors[name].get_generation() for name in names)
+	rendered_generation, families, bodies = _rendered.get(names, (None, None, {}))
+
+	if rendered_generation != generation:
+		families, complete = collect(names, deadline)
+		bodies = {}
+
+		# Don't hold on to a body that is missing late collectors
+		if complete:
+			_rendered[names] = (generation, families, bodies)
+
+	if ( format, 'identity' ) not in bodies:
+		chunks = []
+		write(families, chunks.append)
+		bodies[( format, 'identity' )] = (b"".join(chunks), None)
+
+	if ( format, encoding ) not in bodies:
+		compressor = get_compressor(encoding)
+
+		# Flush so the stream can be continued from a copy of the compressor
+		head = compressor.compress(bodies[( format, 'identity' )][0])
+		head += compressor.flush(zlib.Z_SYNC_FLUSH)
+		bodies[( format, encoding )] = (head, compressor)
+
+	head, compressor = bodies[( format, encoding )]
+
+	chunks = []
+	write(
+		[ collect_data_age(names) ] + util.collect_instrumentation(names),
+		chunks.append
+	)
+	chunks.append(exposition.FORMATS[format]['eof'])
+	tail = b"".join(chunks)
+
+	if compressor:
+		compressor = compressor.copy()
+		tail = compressor.compress(tail) + compressor.flush()
+
+	return head + tail
+
+class ExporterHttpRequestHandler(http.server.SimpleHTTPRequestHandler):
+	# Keep connections open between scrapes, every response sets a
+	# Content-Length so clients know where it ends.
+	protocol_version = 'HTTP/1.1'
+
+	# Read timeout for client sockets so a stuck connection can't hold on to a
+	# worker forever.
+	timeout = float(_conf.get('server_timeout'))
+
+	# Seconds a kept-alive connection may sit idle between requests
+	keep_alive_timeout = float(_conf.get('server_keep_alive_timeout'))
+
+	# Headers and body go out in separate writes, don't let Nagle's algorithm
+	# hold back the body until the client ACKs the headers.
+	disable_nagle_algorithm = True
+
+	def handle(self):
+		self.close_connection = True
+		self.handle_one_request()
+		while not self.close_connection:
+			if not self.wait_request():
+				break
+			self.handle_one_request()
+
+	def wait_request(self) -> bool:
+		"""
+		Waits up to `keep_alive_timeout` seconds for the next request on a
+		kept-alive connection, without holding on to a server worker
+		meanwhile. A serial server can't serve anyone else while waiting, so it
+		closes connections after each request instead.
+
+		```
+		:return: If a request came in
+		:rtype: bool
+		```
+		"""
+		if not isinstance(self.server, ExporterHttpServer):
+			return False
+
+		with self.server.idle():
+			readable, _, _ = select.select([ self.connection ], [], [], self.keep_alive_timeout)
+		return bool(readable)
+
+	def send_body(self, code: int, body: bytes, encoding: str = 'identity', content_type: str = 'text/plain') -> None:
+		self.send_response(code)
+		self.send_header("Content-type", content_type)
+		self.send_header("Vary", "Accept, Accept-Encoding")
+		if encoding != 'identity':
+			self.send_header("Content-Encoding", encoding)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+
+		self.wfile.write(body)
+
+	def send_stream(self, names: tuple, format: str = 'text', encoding: str = 'identity', deadline: float = None) -> None:
+		"""
+		Streams the exposition with chunked transfer encoding, so the first
+		metric families go out while later ones are still being collected.
+
+		```
+		:return: None
+		:rtype: None
+		```
+		"""
+		self.send_response(200)
+		self.send_header("Content-type", exposition.FORMATS[format]['content_type'])
+		self.send_header("Vary", "Accept, Accept-Encoding")
+		if encoding != 'identity':
+			self.send_header("Content-Encoding", encoding)
+		self.send_header("Transfer-Encoding", "chunked")
+		self.end_headers()
+
+		compressor = get_compressor(encoding)
+
+		def write_chunk(chunk: bytes) -> None:
+			if chunk:
+				self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+
+		def write(text: bytes) -> None:
+			if compressor:
+				# Flush so each chunk reaches the client right away
+				text = compressor.compress(text) + compressor.flush(zlib.Z_SYNC_FLUSH)
+			write_chunk(text)
+
+		try:
+			exposition.FORMATS[format]['write'](stream(names, deadline), write, STREAM_CHUNK_SIZE)
+			write(exposition.FORMATS[format]['eof'])
+			if compressor:
+				write_chunk(compressor.flush())
+		except Exception:
+			# Too late for an error status, end the connection without the
+			# last chunk so the scrape fails.
+			_logger.exception("Could not stream the exposition")
+			self.close_connection = True
+			return
+
+		self.wfile.write(b"0\r\n\r\n")
+
+	def get_deadline(self) -> float:
+		"""
+		Gets the time by which the response has to go out for Prometheus to
+		not give up on the scrape, leaving `scrape_timeout_offset` seconds to
+		send it.
+
+		```
+		:return: Deadline as a unix time stamp, None if the scraper sent no timeout
+		:rtype: float
+		```
+		"""
+		try:
+			timeout = float(self.headers.get('X-Prometheus-Scrape-Timeout-Seconds'))
+		except (TypeError, ValueError):
+			return None
+		return time.time() + timeout - float(_conf.get('scrape_timeout_offset'))
+
+	def send_metrics(self, names: list, query: dict) -> None:
+		start = time.perf_counter()
+		deadline = self.get_deadline()
+
+		# Same as other Prometheus exporters, collect[] narrows down which
+		# collectors are included in this scrape.
+		if 'collect[]' in query:
+			unknown = set(query['collect[]']) - set(_collectors.keys())
+			if unknown:
+				self.send_body(400, bytes(
+					"400 Unknown collector: %s\n" % ', '.join(sorted(unknown)),
+					"utf8"
+				))
+				return
+			names = [ name for name in names if name in query['collect[]'] ]
+
+		format = get_format(self.headers.get('Accept', ''))
+		encoding = get_encoding(self.headers.get('Accept-Encoding', ''))
+
+		# Chunked transfer encoding needs HTTP/1.1 clients
+		if _conf.getboolean('server_streaming') and self.request_version == 'HTTP/1.1':
+			self.send_stream(tuple(names), format, encoding, deadline)
+		else:
+			self.send_body(
+				200,
+				render(tuple(names), format, encoding, deadline),
+				encoding,
+				exposition.FORMATS[format]['content_type']
+			)
+
+		util.record(
+			'iot_exporter_scrape_duration_seconds',
+			(('collectors', ','.join(names)),),
+			time.perf_counter() - start
+		)
+
+	def send_profile(self, query: dict) -> None:
+		try:
+			seconds = float(query.get('seconds', [ 10 ])[0])
+			interval = float(query.get('interval', [ 0.01 ])[0])
+			if not math.isfinite(seconds) or not math.isfinite(interval):
+				raise ValueError
+		except ValueError:
+			self.send_body(400, bytes("400 seconds and interval need to be finite numbers\n", "utf8"))
+			return
+
+		try:
+			stacks = profiler.sample(seconds, interval)
+		except RuntimeError as e:
+			self.send_body(409, bytes("409 %s\n" % e, "utf8"))
+			return
+
+		if query.get('format', [ 'collapsed' ])[0] == 'pstats':
+			self.send_body(200, bytes(profiler.get_stats(stacks), "utf8"))
+		else:
+			self.send_body(200, bytes(profiler.get_collapsed(stacks), "utf8"))
+
+	def do_GET(self):
+		url = urllib.parse.urlsplit(self.path)
+		query = urllib.parse.parse_qs(url.query)
+
+		match url.path.rstrip('/').split('/'):
+			case [ '', 'metrics' ]:
+				self.send_metrics(list(_collectors.keys()), query)
+				return
+			case [ '', 'metrics', name ] if name in _collectors:
+				self.send_metrics([ name ], query)
+				return
+			case [ '', 'debug', 'history' ] if _conf.getboolean('debug_endpoints'):
+				self.send_body(
+					200,
+					bytes(json.dumps(history.dump(query.get('source', [ None ])[0])), "utf8"),
+					content_type = 'application/json'
+				)
+				return
+			case [ '', 'debug', 'profile' ] if _conf.getboolean('debug_endpoints'):
+				self.send_profile(query)
+				return
+			case [ '', 'debug', 'tracemalloc' ] if _conf.getboolean('debug_endpoints'):
+				self.send_body(200, bytes(profiler.get_tracemalloc(), "utf8"))
+				return
+			case _:
+				self.send_body(404, bytes(
+					"404 Not Found\n",
+					"utf8"
+				))
+				return
+
+class ExporterHttpServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+	"""
+	Serves each connection on its own thread, capped at `max_threads` workers.
+	Once all workers are busy new connections wait in the listen backlog of
+	`backlog` connections, beyond that the kernel drops them and clients
+	only retry after a second or more.
+	"""
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, server_address: tuple, handler, max_threads: int, backlog: int):
+		self._workers = threading.BoundedSemaphore(max_threads)
+		self.request_queue_size = backlog
+		super().__init__(server_address, handler)
+
+	def process_request(self, request, client_address):
+		self._workers.acquire()
+		try:
+			super().process_request(request, client_address)
+		except Exception:
+			self._workers.release()
+			raise
+
+	def process_request_thread(self, request, client_address):
+		try:
+			super().process_request_thread(request, client_address)
+		finally:
+			self._workers.release()
+
+	@contextlib.contextmanager
+	def idle(self):
+		"""
+		Gives up the worker of the calling connection while it waits for its
+		next request, and takes a worker again after, waiting for one to free up
+		if all are busy.
+		"""
+		self._workers.release()
+		try:
+			yield
+		finally:
+			self._workers.acquire()
+
+def get_server() -> socketserver.TCPServer:
+	"""
+	Creates the HTTP server based on the `[DEFAULT]` configs, falls back to a
+	serial server when `server_threads` is 1 or less.
+
+	```
+	:return: The server ready to serve_forever()
+	:rtype: socketserver.TCPServer
+	```
+	"""
+	server_address = (_conf.get('server_host'), int(_conf.get('server_port')))
+	max_threads = int(_conf.get('server_threads'))
+
+	if max_threads <= 1:
+		return socketserver.TCPServer(server_address, ExporterHttpRequestHandler)
+
+	_logger.info("Serving with up to %i worker threads", max_threads)
+	return ExporterHttpServer(
+		server_address,
+		ExporterHttpRequestHandler,
+		max_threads,
+		int(_conf.get('server_backlog'))
+	)
@@ -0,0 +1,97 @@
+"""
+Persists exporter caches to disk so a restart can serve warm data right away
+instead of refetching everything from upstream APIs.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from iot_exporter import util
+
+_logger = logging.getLogger(__name__)
+_conf = util.get_conf()['DEFAULT']
+_connection = None
+_lock = threading.Lock()
+
+def get_connection() -> sqlite3.Connection:
+	"""
+	Opens the SQLite cache file set by `cache_file`, creating it as needed.
+
+	```
+	:return: The connection or None if persisting caches is turned off
+	:rtype: sqlite3.Connection
+	```
+	"""
+	global _connection
+
+	if _connection is None and _conf.get('cache_file'):
+		_connection = sqlite3.connect(
+			_conf.get('cache_file'),
+			check_same_thread=False
+		)
+		_connection.execute(
+			"CREATE TABLE IF NOT EXISTS cache ("
+			"key TEXT PRIMARY KEY, value TEXT NOT NULL, time_stamp REAL NOT NULL"
+			")"
+		)
+		_connection.commit()
+		_logger.debug("Opened cache file: %s", _conf.get('cache_file'))
+
+	return _connection
+
+def load(key: str, default = None):
+	"""
+	Loads a value saved under `key` by a previous run.
+
+	```
+	:return: The saved value or default if there is none
+	:rtype: Any
+	```
+	"""
+	with _lock:
+		try:
+			connection = get_connection()
+			if connection is None:
+				return default
+
+			row = connection.execute(
+				"SELECT value FROM cache WHERE key = ?",
+				(key,)
+			).fetchone()
+		except sqlite3.Error:
+			_logger.exception("Could not load %s from the cache file", key)
+			return default
+
+	if row is None:
+		return default
+
+	_logger.debug("Restored %s from the cache file", key)
+	return json.loads(row[0])
+
+def save(key: str, value) -> None:
+	"""
+	Saves a JSON serializable value under `key` for the next run.
+
+	```
+	:return: None
+	:rtype: None
+	```
+	"""
+	data = json.dumps(value)
+
+	with _lock:
+		try:
+			connection = get_connection()
+			if connection is None:
+				return
+
+			with connection:
+				connection.execute(
+					"INSERT OR REPLACE INTO cache (key, value, time_stamp) VALUES (?, ?, ?)",
+					(key, data, time.time())
+				)
+		except sqlite3.Error:
+			_logger.exception("Could not save %s to the cache file", key)
@@ -2,12 +2,69 @@
 Util functions used across different exporters.
 """
 
+import bisect
+import collections
 import configparser
+import functools
 import logging
 import os 
+import threading
+import time
 
 _logger = logging.getLogger(__name__)
 _config = None
+_instrumentation = {}
+_instrumentation_lock = threading.Lock()
+
+# Value of settings the user still has to fill in
+PLACEHOLDER = 'REPLACE_ME'
+
+#
+# Configure Instrumentation Metrics
+#
+
+INSTRUMENTATION = {
+
+	'iot_exporter_refresh_duration_seconds': {
+		'HELP': 'Time taken by a background job, the refresh of upstream data or others like the beestat sync.',
+		'TYPE': 'histogram',
+		'UNIT': 'seconds',
+		'buckets': [ 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60 ],
+	},
+
+	'iot_exporter_collect_duration_seconds': {
+		'HELP': 'Time taken to render the exposition of an exporter from cached data.',
+		'TYPE': 'histogram',
+		'UNIT': 'seconds',
+		'buckets': [ 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5 ],
+	},
+
+	'iot_exporter_upstream_request_duration_seconds': {
+		'HELP': 'Time taken by upstream API requests including reading the response.',
+		'TYPE': 'histogram',
+		'UNIT': 'seconds',
+		'buckets': [ 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30 ],
+	},
+
+	'iot_exporter_upstream_response_size_bytes': {
+		'HELP': 'Size of upstream API response bodies.',
+		'TYPE': 'histogram',
+		'UNIT': 'bytes',
+		'buckets': [ 256, 1024, 4096, 16384, 65536, 262144, 1048576 ],
+	},
+
+	'iot_exporter_upstream_responses_total': {
+		'HELP': 'Count of upstream API responses by status code, code is error if no response was received.',
+		'TYPE': 'counter',
+	},
+
+	'iot_exporter_scrape_duration_seconds': {
+		'HELP': 'Time taken to serve the previous scrape of the same collectors.',
+		'TYPE': 'gauge',
+		'UNIT': 'seconds',
+	},
+
+}
 
 def get_conf() -> configparser.ConfigParser:
 	"""
@@ -31,9 +88,492 @@ def get_conf() -> configparser.ConfigParser:
 		_logger.debug("Loaded the following config files: %s", config_files_read)
 	return _config
 
+def is_configured(section) -> bool:
+	"""
+	Checks if a config section got an `api_key`, rather than still having the
+	REPLACE_ME placeholder.
+
+	```
+	:return: If the section is configured
+	:rtype: bool
+	```
+	"""
+	return section.get('api_key') != PLACEHOLDER
+
+def get_accounts(name: str) -> list:
+	"""
+	Gets the config sections of an exporter's accounts, the `[name]` section
+	and any `[name:<account>]` sections.
+
+	```
+	:return: ( account name, section ) tuples, the account name of `[name]` is empty
+	:rtype: list
+	```
+	"""
+	conf = get_conf()
+	return [ ( '', conf[name] ) ] + [
+		( section.partition(':')[2], conf[section] )
+		for section in conf.sections()
+		if section.startswith(f'{name}:')
+	]
+
 def to_label_param(labels: dict) -> str:
 	params = []
 	for label_name, label_value in labels.items():
 		escaped = str(label_value).replace('\\','\\\\').replace('"','\\"')
 		params.append(f'{label_name}="{escaped}"')
 	return ','.join(params)
+
+def get_header(metric_name: str, metric_def: dict) -> str:
+	"""
+	Builds the `# TYPE`, `# UNIT` and `# HELP` lines for a metric definition.
+	Results are cached by `exposition.get_text_header` so scrapes only reuse
+	them.
+
+	```
+	:return: The header lines for the metric
+	:rtype: str
+	```
+	"""
+	lines = []
+	for desc in [ 'TYPE', 'UNIT', 'HELP' ]:
+		if desc in metric_def:
+			lines.append("# %s %s %s" % (
+				desc,
+				metric_name,
+				metric_def[desc]
+			))
+	return "\n".join(lines)
+
+def memoize(max_size: int):
+	"""
+	Caches the results of a function for up to `max_size` distinct arguments.
+	Unlike an LRU cache, once full it keeps what it has and stops caching new
+	results. Every scrape renders all series in the same order, so an LRU
+	cache smaller than the number of series would evict each entry right
+	before it's needed again and never hit, while this still hits for the
+	first `max_size` series.
+
+	```
+	:return: Decorator for the function
+	:rtype: Callable
+	```
+	"""
+	def decorator(function):
+		cache = {}
+
+		@functools.wraps(function)
+		def wrapper(*args):
+			try:
+				return cache[args]
+			except KeyError:
+				pass
+			result = function(*args)
+			if len(cache) < max_size:
+				cache[args] = result
+			return result
+
+		wrapper.cache = cache
+		return wrapper
+
+	return decorator
+
+# Distinct label sets to cache encoded sample prefixes for, at about 300
+# bytes each
+LABELS_CACHE_SIZE = 65536
+
+@memoize(LABELS_CACHE_SIZE)
+def get_sample_prefix(metric_name: str, labels: tuple) -> str:
+	"""
+	Builds the `metric_name{labels} ` start of a sample line from a tuple of
+	label name and value pairs. Results are cached so label values are only
+	escaped once for each distinct label set.
+
+	```
+	:return: The sample line up to the value
+	:rtype: str
+	```
+	"""
+	return "%s{%s} " % (
+		metric_name,
+		to_label_param(dict(labels))
+	)
+
+def record(metric_name: str, labels: tuple, value: float) -> None:
+	"""
+	Records a value for one of the INSTRUMENTATION metrics, histograms observe
+	the value, counters add to it and gauges are set to it.
+
+	```
+	:return: None
+	:rtype: None
+	```
+	"""
+	metric_def = INSTRUMENTATION[metric_name]
+
+	with _instrumentation_lock:
+		series = _instrumentation.setdefault(metric_name, {})
+
+		match metric_def['TYPE']:
+			case 'histogram':
+				if labels not in series:
+					series[labels] = {
+						'buckets': [ 0 ] * len(metric_def['buckets']),
+						'sum': 0,
+						'count': 0,
+					}
+				state = series[labels]
+				index = bisect.bisect_left(metric_def['buckets'], value)
+				if index < len(state['buckets']):
+					state['buckets'][index] += 1
+				state['sum'] += value
+				state['count'] += 1
+			case 'counter':
+				series[labels] = series.get(labels, 0) + value
+			case 'gauge':
+				series[labels] = value
+
+def collect_instrumentation(collectors: tuple) -> list:
+	"""
+	Collects the INSTRUMENTATION metrics for the given collectors. Series
+	without a collector label are always included, series recorded for a set
+	of collectors only when it is the same set.
+
+	```
+	:return: Metric families
+	:rtype: list
+	```
+	"""
+	from iot_exporter import exposition
+
+	families = []
+
+	with _instrumentation_lock:
+		for metric_name, metric_def in INSTRUMENTATION.items():
+			family = exposition.MetricFamily(metric_name, metric_def)
+			families.append(family)
+
+			for labels, state in _instrumentation.get(metric_name, {}).items():
+				label_dict = dict(labels)
+				if 'collector' in label_dict and label_dict['collector'] not in collectors:
+					continue
+				if 'collectors' in label_dict and label_dict['collectors'] != ','.join(collectors):
+					continue
+
+				if metric_def['TYPE'] != 'histogram':
+					family.add(labels, float(state))
+					continue
+
+				cumulative = 0
+				for le, count in zip(metric_def['buckets'], state['buckets']):
+					cumulative += count
+					family.add(labels + (('le', le),), cumulative, suffix='_bucket')
+				family.add(labels + (('le', '+Inf'),), state['count'], suffix='_bucket')
+				family.add(labels, float(state['sum']), suffix='_sum')
+				family.add(labels, state['count'], suffix='_count')
+
+	return families
+
+class Cache:
+	"""
+	TTL cache shared by the exporters for upstream API data.
+
+	 - Every entry has its own TTL.
+	 - Only one caller at a time fetches a key (single-flight), everyone else
+	   keeps getting the current value meanwhile (stale-while-revalidate).
+	 - Failed fetches are retried after a backoff that doubles with each
+	   consecutive failure, cached values keep being served for up to
+	   `cache_max_stale` seconds past their TTL.
+	 - Keys are kept in LRU order, keys nobody used for `cache_max_stale`
+	   seconds or above `cache_max_size` are evicted. Exporters drop keys
+	   that are no longer configured with `retain()`.
+	 - Entries are persisted with `store` when saved.
+
+	Exporters either use `get()` with a fetch function, or `claim()` keys and
+	then `set()` or `fail()` each claimed key when batching fetches.
+	"""
+
+	# Keys expiring within this many seconds may be claimed early, so keys set
+	# together in a batch also expire together.
+	claim_slack = 1
+
+	def __init__(self, name: str):
+		conf = get_conf()['DEFAULT']
+
+		self.name = name
+		self.max_size = int(conf.get('cache_max_size'))
+		self.max_stale = float(conf.get('cache_max_stale'))
+		self.backoff = float(conf.get('cache_backoff'))
+		self.max_backoff = float(conf.get('cache_max_backoff'))
+		self.counts = {
+			'hit': 0,
+			'miss': 0,
+		}
+		# Goes up whenever a served value changes
+		self.version = 0
+
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Condition()
+		# Keys of the last retain(), these are configured
+		self._retained = set()
+
+		self.load()
+
+	def get_entry(self, key) -> dict:
+		# Must hold the lock
+		if key not in self._entries:
+			self._entries[key] = {
+				'value': None,
+				'time_stamp': 0,
+				'ttl': 0,
+				'used': 0,
+				'errors': 0,
+				'retry_at': 0,
+				'fetching': False,
+			}
+		entry = self._entries[key]
+		entry['used'] = time.time()
+		self._entries.move_to_end(key)
+		return entry
+
+	def evict(self) -> None:
+		# Must hold the lock. Configured keys are only evicted once stale,
+		# max_size bounds all other keys so it doesn't limit how many sensors
+		# can be configured.
+		now = time.time()
+		unretained = sum(1 for key in self._entries if key not in self._retained)
+		for key, entry in list(self._entries.items()):
+			if entry['fetching']:
+				continue
+			oversized = key not in self._retained and unretained > self.max_size
+			if oversized or now - entry['used'] > self.max_stale:
+				_logger.debug("Evicting %s from the %s cache", key, self.name)
+				del self._entries[key]
+				self.version += 1
+				if key not in self._retained:
+					unretained -= 1
+
+	def claim(self, key) -> bool:
+		"""
+		Claims an expired key for the caller to fetch. Keys that are still
+		fresh, already being fetched or backing off after a failure can't be
+		claimed.
+
+		```
+		:return: If the caller should fetch the key
+		:rtype: bool
+		```
+		"""
+		with self._lock:
+			entry = self.get_entry(key)
+			now = time.time()
+
+			if entry['fetching']:
+				return False
+			if now + self.claim_slack - entry['time_stamp'] < entry['ttl']:
+				return False
+			if now + self.claim_slack < entry['retry_at']:
+				return False
+
+			entry['fetching'] = True
+			return True
+
+	def set(self, key, value, ttl: float) -> None:
+		with self._lock:
+			entry = self.get_entry(key)
+			if entry['value'] != value:
+				self.version += 1
+			entry['value'] = value
+			entry['time_stamp'] = time.time()
+			entry['ttl'] = ttl
+			entry['errors'] = 0
+			entry['retry_at'] = 0
+			entry['fetching'] = False
+
+			self.evict()
+			self._lock.notify_all()
+
+	def fail(self, key) -> None:
+		with self._lock:
+			entry = self.get_entry(key)
+			entry['errors'] += 1
+			entry['retry_at'] = time.time() + min(
+				self.backoff * 2 ** ( entry['errors'] - 1 ),
+				self.max_backoff
+			)
+			entry['fetching'] = False
+
+			_logger.debug(
+				"Fetching %s for the %s cache failed %i times in a row",
+				key,
+				self.name,
+				entry['errors']
+			)
+			self._lock.notify_all()
+
+	def peek(self, key):
+		"""
+		Gets the cached value of a key without fetching it, values are served
+		for up to `cache_max_stale` seconds past their TTL.
+
+		```
+		:return: The cached value or None
+		:rtype: Any
+		```
+		"""
+		with self._lock:
+			if key not in self._entries:
+				return None
+			entry = self.get_entry(key)
+			if time.time() - entry['time_stamp'] > entry['ttl'] + self.max_stale:
+				return None
+			return entry['value']
+
+	def wait(self, key, timeout: float = None) -> None:
+		"""
+		Waits for a key that is being fetched by someone else, up to `timeout`
+		seconds.
+		"""
+		with self._lock:
+			self._lock.wait_for(
+				lambda : not self._entries.get(key, {}).get('fetching'),
+				timeout
+			)
+
+	def get(self, key, fetch, ttl: float, timeout: float = None):
+		"""
+		Gets the value of a key, calling `fetch` for a new value once it
+		expired. Fetch functions return None or raise on failure. If another
+		caller is fetching the key and there is no value yet, waits for them
+		up to `timeout` seconds.
+
+		```
+		:return: The cached value or None
+		:rtype: Any
+		```
+		"""
+		if not self.claim(key):
+			self.counts['hit'] += 1
+			if self.peek(key) is None:
+				self.wait(key, timeout)
+			return self.peek(key)
+
+		self.counts['miss'] += 1
+		try:
+			value = fetch()
+		except Exception:
+			self.fail(key)
+			raise
+
+		if value is None:
+			self.fail(key)
+		else:
+			self.set(key, value, ttl)
+
+		return self.peek(key)
+
+	def get_age(self, keys: list) -> float:
+		"""
+		Gets the seconds since the oldest cached value of the given keys was
+		fetched.
+
+		```
+		:return: Age of the oldest value, None if none of the keys has a value
+		:rtype: float
+		```
+		"""
+		now = time.time()
+		with self._lock:
+			ages = [
+				now - self._entries[key]['time_stamp']
+				for key in keys
+				if key in self._entries and self._entries[key]['value'] is not None
+			]
+		if not ages:
+			return None
+		return max(ages)
+
+	def retain(self, keys: list) -> None:
+		"""
+		Evicts all keys but the given ones, e.g. sensors that are no longer
+		configured or keys of older versions restored from the cache file.
+		Those would otherwise count as expired and have the exporter refresh
+		over and over until they are evicted.
+
+		```
+		:return: None
+		:rtype: None
+		```
+		"""
+		keys = set(keys)
+		with self._lock:
+			self._retained = keys
+			for key, entry in list(self._entries.items()):
+				if key not in keys and not entry['fetching']:
+					_logger.debug("Evicting %s from the %s cache, it's no longer configured", key, self.name)
+					del self._entries[key]
+					self.version += 1
+
+	def get_version(self) -> tuple:
+		"""
+		Gets the version of the values the cache serves, which changes when a
+		value is set to something new, is evicted, or gets too stale to be
+		served.
+
+		```
+		:return: The version
+		:rtype: tuple
+		```
+		"""
+		now = time.time()
+		with self._lock:
+			too_stale = sum(
+				1 for entry in self._entries.values()
+				if entry['value'] is not None and now - entry['time_stamp'] > entry['ttl'] + self.max_stale
+			)
+			return ( self.version, too_stale )
+
+	def next_expiry(self) -> float:
+		"""
+		Gets the seconds until the first key expires or may be retried.
+
+		```
+		:return: Seconds until a refresh is needed, None if the cache is empty
+		:rtype: float
+		```
+		"""
+		now = time.time()
+		with self._lock:
+			expiries = [
+				max(entry['time_stamp'] + entry['ttl'], entry['retry_at']) - now
+				for entry in self._entries.values()
+				if not entry['fetching']
+			]
+		if not expiries:
+			return None
+		return max(0, min(expiries))
+
+	def load(self) -> None:
+		from iot_exporter import store
+
+		with self._lock:
+			for key, value, time_stamp, ttl in store.load(f'cache.{self.name}', []):
+				# JSON turns tuple keys into lists
+				if isinstance(key, list):
+					key = tuple(key)
+				entry = self.get_entry(key)
+				entry['value'] = value
+				entry['time_stamp'] = time_stamp
+				entry['ttl'] = ttl
+			self.version += 1
+
+	def save(self) -> None:
+		from iot_exporter import store
+
+		with self._lock:
+			entries = [
+				[ key, entry['value'], entry['time_stamp'], entry['ttl'] ]
+				for key, entry in self._entries.items()
+				if entry['value'] is not None
+			]
+		store.save(f'cache.{self.name}', entries)